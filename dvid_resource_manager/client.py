@@ -1,16 +1,129 @@
 import os
 import json
+import time
+import struct
+import asyncio
+import weakref
+import contextvars
 import threading
-from contextlib import closing, contextmanager
+from contextlib import asynccontextmanager
 
+import orjson
 import jsonschema
 import zmq
+import zmq.asyncio
 
-from dvid_resource_manager.schemas import RequestMessageSchema, HoldMessageSchema, ReleaseMessageSchema, ConfigSchema
+from dvid_resource_manager.schemas import ( RequestMessageSchema, HoldMessageSchema, ReleaseMessageSchema,
+                                             BatchRequestMessageSchema, BatchReleaseMessageSchema, ConfigSchema,
+                                             BinaryMessageFormat, BinaryMessageOpcodes )
+
+def _compile_validator(schema):
+    """
+    Build a reusable validator for the given schema.
+    jsonschema.validate() re-checks the schema and constructs
+    a new validator on every call, so we do that just once, at import.
+    """
+    jsonschema.Draft7Validator.check_schema(schema)
+    return jsonschema.Draft7Validator(schema)
+
+_REQUEST_VALIDATOR = _compile_validator(RequestMessageSchema)
+_HOLD_VALIDATOR = _compile_validator(HoldMessageSchema)
+_RELEASE_VALIDATOR = _compile_validator(ReleaseMessageSchema)
+_BATCH_REQUEST_VALIDATOR = _compile_validator(BatchRequestMessageSchema)
+_BATCH_RELEASE_VALIDATOR = _compile_validator(BatchReleaseMessageSchema)
+_CONFIG_VALIDATOR = _compile_validator(ConfigSchema)
+
+##
+## Hand-written equivalents of the above validators (except for the config),
+## which are much faster for these small, fixed-format messages.
+## (We use type() instead of isinstance(), since bool is a subclass of int.)
+##
+
+def _check_request_message(msg):
+    assert msg["type"] == "request"
+    assert type(msg["resource"]) is str
+    assert type(msg["read"]) is bool
+    assert type(msg["numopts"]) is int
+    assert type(msg["datasize"]) is int
+    assert type(msg.get("priority", 0)) is int
+    assert type(msg.get("skip_hold_ack", False)) is bool
+
+def _check_hold_message(msg):
+    assert msg["type"] == "hold"
+    assert type(msg["id"]) is int
+
+def _check_release_message(msg):
+    assert msg["type"] == "release"
+    assert type(msg["id"]) is int
+
+def _check_batch_request_message(msg):
+    assert msg["type"] == "batch-request"
+    assert type(msg.get("priority", 0)) is int
+    for item in msg["items"]:
+        assert type(item["resource"]) is str
+        assert type(item["read"]) is bool
+        assert type(item["numopts"]) is int
+        assert type(item["datasize"]) is int
+
+def _check_batch_release_message(msg):
+    assert msg["type"] == "batch-release"
+    assert all(type(request_id) is int for request_id in msg["ids"])
+
+# 'hold' and 'release' are sent in binary form (see schemas.py)
+_BINARY_MESSAGE = struct.Struct(BinaryMessageFormat)
+_HOLD_OPCODE = BinaryMessageOpcodes["hold"]
+_RELEASE_OPCODE = BinaryMessageOpcodes["release"]
+
+# How long to wait for the server to reply to a message, which might take a while
+# if the server is busy with other clients.  When there are 1000 clients,
+# a timeout of 2 seconds seems to be too short, but 4 seconds is enough.
+# For 2000 clients, 4 seconds is still too short.
+REPLY_TIMEOUT_MS = 4000
 
 class TimeoutError(RuntimeError):
     pass
 
+class ResourceUnavailableError(RuntimeError):
+    """
+    Raised when the resource isn't available right now,
+    and the server doesn't queue requests (it was started with --no-queuing).
+    """
+    pass
+
+
+def _exceeds_config_error(config, req_data):
+    msg = (
+        "Cannot acquire access to the shared resource because "
+        "your request exceeds the server's config maximums.\n"
+        f"Config maximums: {json.dumps(config)}\n"
+        f"Your request: {json.dumps(req_data)}")
+    return RuntimeError(msg)
+
+
+def _unavailable_error(req_data):
+    msg = (
+        "Cannot acquire access to the shared resource because it is in use, "
+        "and the server does not queue requests.\n"
+        f"Your request: {json.dumps(req_data)}")
+    return ResourceUnavailableError(msg)
+
+
+def _grant_topic(request_id):
+    """
+    The subscription topic for the server's notification that
+    the given request has been granted.
+    The server publishes each id as a fixed-width (8-byte, big-endian) message,
+    so a topic can't accidentally match other ids with the same prefix.
+    """
+    return request_id.to_bytes(8, "big")
+
+
+def _published_topic(msg):
+    """
+    Return the _grant_topic() that matches the given message from the server.
+    """
+    return msg[:8]
+
 
 class ResourceManagerClient:
     """
@@ -33,30 +146,71 @@ class ResourceManagerClient:
         with client.access_context( data_server_ip, False, 1, volume_bytes ):
             send_data(...)
     """
-    def __init__(self, server_ip, server_port, _debug=False):
+    def __init__(self, server_ip, server_port, _debug=False, _strict_debug=False):
         assert server_ip != "driver", "Invalid server_ip"  # Possible mistake when using flyemflows.
         self.server_ip = server_ip
         self.server_port = server_port
         self._debug = _debug
-        self._clients = {}
-    
+        self._strict_debug = _strict_debug
+        self._init_client_storage()
+        _all_managers.add(self)
+
+    def _init_client_storage(self):
+        # Each thread's client is stored in thread-local storage,
+        # which is cheaper to access than a dict keyed by (thread_id, pid).
+        # We also keep a weak set of all clients, for close().
+        # (A thread's client is discarded when the thread exits.)
+        # After a fork, the child process calls this again (see _reset_after_fork()).
+        self._local = threading.local()
+        self._clients = weakref.WeakSet()
+        self._clients_lock = threading.Lock()
+
     def _get_client(self):
         if not self.server_ip:
             return _DummyClient()
 
-        thread_id = threading.current_thread().ident
-        pid = os.getpid()
-    
         try:
-            client = self._clients[(thread_id, pid)]
-        except KeyError:
-            client = _ResourceManagerClient(self.server_ip, self.server_port, self._debug)
-            self._clients[(thread_id, pid)] = client
-    
+            return self._local.client
+        except AttributeError:
+            pass
+
+        # First use in this thread (or first use after a fork).
+        client = _ResourceManagerClient(self.server_ip, self.server_port, self._debug, self._strict_debug)
+        self._local.client = client
+        with self._clients_lock:
+            self._clients.add(client)
         return client
     
-    def access_context(self, resource_name, is_read, num_reqs, data_size):
-        return self._get_client().access_context(resource_name, is_read, num_reqs, data_size)
+    def access_context(self, resource_name, is_read, num_reqs, data_size, priority=0):
+        return self._get_client().access_context(resource_name, is_read, num_reqs, data_size, priority)
+    
+    def batch_access_context(self, requests, priority=0):
+        return self._get_client().batch_access_context(requests, priority)
+    
+    def access_context_async(self, resource_name, is_read, num_reqs, data_size, priority=0):
+        """
+        Like access_context(), but returns an async context manager.
+        Any number of tasks (in the same thread) may use it concurrently:
+
+            async with client.access_context_async( data_server_ip, False, 1, volume_bytes ):
+                await send_data(...)
+        """
+        return self._get_async_client().access_context(resource_name, is_read, num_reqs, data_size, priority)
+    
+    def _get_async_client(self):
+        if not self.server_ip:
+            return _DummyClient()
+
+        try:
+            return self._local.async_client
+        except AttributeError:
+            pass
+
+        client = _AsyncResourceManagerClient(self.server_ip, self.server_port, self._debug, self._strict_debug)
+        self._local.async_client = client
+        with self._clients_lock:
+            self._clients.add(client)
+        return client
     
     def reconfigure_server(self, config):
         return self._get_client().reconfigure_server(config)
@@ -65,7 +219,18 @@ class ResourceManagerClient:
         return self._get_client().read_config()
     
     def close(self):
-        for client in self._clients.values():
+        """
+        Close all of this object's per-thread clients.
+        (It can still be used afterwards; new clients will be created as needed.)
+
+        Note: This is quick, regardless of the number of clients, since the clients
+              share a zmq context, which is not terminated here.  Closing a socket
+              doesn't block, even if it has a nonzero LINGER period.
+        """
+        with self._clients_lock:
+            clients = list(self._clients)
+        self._init_client_storage()
+        for client in clients:
             client.close()
 
     def __getstate__(self):
@@ -73,9 +238,219 @@ class ResourceManagerClient:
         Pickle support
         """
         d = self.__dict__.copy()
-        d['_clients'] = {}
+        del d['_local']
+        del d['_clients']
+        del d['_clients_lock']
         return d
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_client_storage()
+        _all_managers.add(self)
+
+
+# All ResourceManagerClient instances in this process.
+_all_managers = weakref.WeakSet()
+
+def _reset_after_fork():
+    """
+    In a forked child process, the parent's zmq sockets are unusable,
+    so discard every client's per-thread _ResourceManagerClients,
+    and the parent's wait dispatchers.
+    (New ones are created on demand.)
+    """
+    for manager in list(_all_managers):
+        manager._init_client_storage()
+    _WaitDispatcher._reset_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# The ids of the _ResourceManagerClients with an active AccessContext
+# in the current thread (or asyncio task).
+# (One ContextVar for all clients: ContextVars should be created at module level, not per object.)
+_active_clients = contextvars.ContextVar("active-resource-manager-clients", default=frozenset())
+
+
+class _WaitDispatcher:
+    """
+    Waits for the server's grant notifications on behalf of all
+    _ResourceManagerClients in this process (in any thread)
+    which use the same server.
+
+    A single background thread owns the SUB socket, so the number of
+    sockets and threads doesn't grow with the number of pending waits.
+    Since zmq sockets are not threadsafe, waiting threads don't touch
+    the SUB socket directly; they send their (un)subscription requests
+    to the background thread over an inproc socket.
+
+    Each client holds a reference (see acquire() and release()).
+    When the last one is released, the background thread closes
+    its sockets and exits.
+    """
+    _instances = {}
+
+    # (Reentrant, since a client's __del__ may release a dispatcher
+    # during garbage collection while this thread already holds the lock.)
+    _instances_lock = threading.RLock()
+
+    @classmethod
+    def acquire(cls, server_ip, server_port):
+        """
+        Return the dispatcher for the given server (creating it if necessary),
+        and add a reference to it.  The caller must release() it when it's done.
+        """
+        key = (server_ip, server_port, os.getpid())
+        with cls._instances_lock:
+            dispatcher = cls._instances.get(key)
+            if dispatcher is None or dispatcher._error is not None:
+                # (If the background thread died, start over with a new dispatcher.)
+                dispatcher = cls._instances[key] = _WaitDispatcher(server_ip, server_port, key)
+            dispatcher._refcount += 1
+            return dispatcher
+
+    @classmethod
+    def _reset_after_fork(cls):
+        # The lock may have been held (by another thread) during the fork,
+        # and the parent's dispatchers (and their threads) don't exist in the child.
+        cls._instances_lock = threading.RLock()
+        pid = os.getpid()
+        cls._instances = {key: d for key, d in cls._instances.items() if key[2] == pid}
+
+    def __init__(self, server_ip, server_port, key):
+        context = zmq.Context.instance()
+        self._key = key
+        self._refcount = 0
+
+        # These two sockets are used only by the background thread.
+        self._sub_socket = context.socket(zmq.SUB)
+        self._sub_socket.connect(f'tcp://{server_ip}:{server_port + 1}')
+        self._command_socket = context.socket(zmq.PULL)
+        endpoint = f'inproc://wait-dispatcher-{id(self)}'
+        self._command_socket.bind(endpoint)
+
+        # Shared by the waiting threads (with a lock).
+        # Once the background thread has stopped, no more commands are sent.
+        self._push_socket = context.socket(zmq.PUSH)
+        self._push_socket.connect(endpoint)
+        self._push_lock = threading.Lock()
+        self._stopped = False
+
+        # topic -> threading.Event
+        # If the background thread fails, the exception is stored in _error
+        # (with the _events_lock), and every waiting thread is woken up to raise it.
+        self._events = {}
+        self._events_lock = threading.Lock()
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, name='resource-manager-wait-dispatcher', daemon=True)
+        self._thread.start()
+
+    def release(self):
+        """
+        Remove a reference (from acquire()).
+        The last one stops the background thread and closes the sockets.
+        """
+        cls = _WaitDispatcher
+        with cls._instances_lock:
+            self._refcount -= 1
+            if self._refcount > 0:
+                return
+            if cls._instances.get(self._key) is self:
+                del cls._instances[self._key]
+
+        self._send_command(b"close", [])
+        if threading.current_thread() is not self._thread:
+            self._thread.join(1.0)
+        with self._push_lock:
+            self._push_socket.close(linger=0)
+
+    def wait(self, topics):
+        """
+        Wait until the server has published all of the given topics.
+        """
+        events = [threading.Event() for _ in topics]
+        with self._events_lock:
+            self._check_error()
+            self._events.update(zip(topics, events))
+        try:
+            self._send_command(b"subscribe", topics)
+            for event in events:
+                event.wait()
+                self._check_error()
+        finally:
+            with self._events_lock:
+                for topic in topics:
+                    del self._events[topic]
+            self._send_command(b"unsubscribe", topics)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError("The resource manager client's wait dispatcher thread failed") from self._error
+
+    def _send_command(self, command, topics):
+        with self._push_lock:
+            # (A PUSH socket with no peer would block.)
+            if not self._stopped:
+                self._push_socket.send_multipart([command, *topics])
+
+    def _run(self):
+        try:
+            self._dispatch()
+        except BaseException as ex:
+            with self._events_lock:
+                self._error = ex
+                for event in self._events.values():
+                    event.set()
+        finally:
+            with self._push_lock:
+                self._stopped = True
+                self._command_socket.close(linger=0)
+            self._sub_socket.close(linger=0)
+
+    def _dispatch(self):
+        poller = zmq.Poller()
+        poller.register(self._sub_socket, zmq.POLLIN)
+        poller.register(self._command_socket, zmq.POLLIN)
+        while True:
+            for socket, _ in poller.poll():
+                if socket is self._command_socket:
+                    command, *topics = self._command_socket.recv_multipart()
+                    if command == b"close":
+                        return
+                    option = zmq.SUBSCRIBE if command == b"subscribe" else zmq.UNSUBSCRIBE
+                    for topic in topics:
+                        self._sub_socket.setsockopt(option, topic)
+                else:
+                    topic = _published_topic(self._sub_socket.recv())
+                    with self._events_lock:
+                        event = self._events.get(topic)
+                    if event is not None:
+                        event.set()
+
+
+class _NullContext:
+    """
+    A do-nothing context manager.
+    (Cheaper than a @contextmanager generator, and reusable.)
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *_args):
+        return False
+
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *_args):
+        return False
+
+_NULL_CONTEXT = _NullContext()
+
 
 class _DummyClient:
     """
@@ -84,12 +459,42 @@ class _DummyClient:
     server_ip = ""
     server_port = 0
 
-    @contextmanager
     def access_context(self, *args, **kwargs):
-        yield
+        return _NULL_CONTEXT
+
+    def batch_access_context(self, *args, **kwargs):
+        return _NULL_CONTEXT
     
     
-class _ResourceManagerClient:
+class _ClientMixin:
+    """
+    Helpers shared by _ResourceManagerClient and _AsyncResourceManagerClient.
+    (Each sets _strict_debug and _config_cache in its constructor.)
+    """
+    def _validate(self, msg, check, validator):
+        """
+        Validate an outgoing message (only used when _debug is set).
+        """
+        check(msg)
+        if self._strict_debug:
+            validator.validate(msg)
+
+    def _cached_config(self, ttl):
+        """
+        Return the config stored by _cache_config(), if it was
+        stored within the last ttl seconds.  Otherwise, return None.
+        """
+        timestamp, config = self._config_cache
+        if config is not None and time.monotonic() - timestamp < ttl:
+            return config
+        return None
+
+    def _cache_config(self, config):
+        self._config_cache = (time.monotonic(), config)
+        return config
+
+
+class _ResourceManagerClient(_ClientMixin):
     """
     Usage:
     
@@ -106,22 +511,63 @@ class _ResourceManagerClient:
               so while an AccessContext is active.
     """
 
-    def __init__(self, server_ip, server_port, _debug=False):
+    def __init__(self, server_ip, server_port, _debug=False, _strict_debug=False):
         """
-        _debug: Used during testing.  Forces validation of json schemas
+        _debug: Used during testing.  Forces validation of outgoing messages.
+        _strict_debug: If _debug is also set, validate outgoing messages
+                       with their (slower) json schemas, too.
         """
         self.server_ip = server_ip
         self.server_port = server_port
         self._debug = _debug
-        self._currently_accessing = False
+        self._strict_debug = _strict_debug
+
+        # While an AccessContext is active, the ident of the thread that entered it.
+        # (See _begin_access().)
+        self._accessing_thread = None
+
+        # (timestamp, config) from _cached_read_config()
+        self._config_cache = (0.0, None)
+
+        # Each message we send is tagged with a new value of this counter,
+        # so we can tell the reply to our latest message from
+        # late replies to earlier messages that timed out.
+        self._message_count = 0
+        self._message_tag = None
+
+        # Message templates, updated in-place and re-sent for each acquisition,
+        # rather than constructing new dicts on every call.
+        self._request_msg = {
+            "type": "request",
+            "resource": None,
+            "read": None,
+            "numopts": None,
+            "datasize": None,
+            "priority": 0,
+            "skip_hold_ack": True
+        }
+
         self._initialize_zmq()
 
     def _initialize_zmq(self):
-        self._context = zmq.Context()
+        # All clients in the process share the same context (and its I/O thread).
+        # Each client only creates its own sockets.
+        self._context = zmq.Context.instance()
+        self._pid = os.getpid()
         self._init_socket()
+
+        # Waiting for the server to grant us access is handled by a
+        # dispatcher (with its own SUB socket) shared by all clients
+        # in this process that use the same server.
+        # (The reference is released in close().)
+        self._dispatcher = _WaitDispatcher.acquire(self.server_ip, self.server_port)
     
     def _init_socket(self):
-        self._commsocket = self._context.socket(zmq.REQ)
+        # We use a DEALER socket (not REQ), so we aren't forced into strict
+        # send/recv lockstep, and a timed-out request doesn't leave the
+        # socket in an unusable state.  Each message is sent with an envelope
+        # of [tag, b""], which the server (REP or ROUTER) echoes back to us.
+        self._commsocket = self._context.socket(zmq.DEALER)
         self._commsocket.connect(f'tcp://{self.server_ip}:{self.server_port}')
         self._poller = zmq.Poller()
         self._poller.register(self._commsocket, zmq.POLLIN)
@@ -136,158 +582,692 @@ class _ResourceManagerClient:
         self._poller.unregister(self._commsocket)
 
     def close(self):
+        if self._context is None:
+            # Closed already, or never connected.
+            return
+        if self._pid != os.getpid():
+            # These sockets belong to our parent process (before a fork).
+            # We must not touch them; just drop them.
+            self._context = self._commsocket = self._poller = self._dispatcher = None
+            return
         self._close_socket()
-        self._context.term()
-        self._context = None
+        self._dispatcher.release()
+
+        # Don't term() the context; it's shared with other clients.
+        # (If this client is used again, it reconnects.)
+        self._context = self._commsocket = self._poller = self._dispatcher = None
 
     def __del__(self):
         if self._context is not None:
             self.close()
 
-    def access_context(self, resource_name, is_read, num_reqs, data_size):
+    def access_context(self, resource_name, is_read, num_reqs, data_size, priority=0):
         """
         Primary API function. (See usage above.)
         Returns a contextmanager object.
         While the context is active, access is granted to the the requested resource.  
+
+        priority:
+            While this request is waiting, no request for the same resource
+            with a lower priority is granted any of the stats it needs
+            (even if it would fit and this request doesn't, yet).
+            Among requests with the same priority, one that fits may be granted
+            ahead of an older one that doesn't, so a large request can still be
+            delayed by a stream of smaller ones with the same priority.
+            (Batches are prioritized the same way, along with single requests.)
         """
-        return _ResourceManagerClient.AccessContext(self, resource_name, is_read, num_reqs, data_size)
+        return _ResourceManagerClient.AccessContext(self, resource_name, is_read, num_reqs, data_size, priority)
+
+    def batch_access_context(self, requests, priority=0):
+        """
+        Like access_context(), but acquires several resources at once,
+        using a single round-trip to the server (and a single one to release them).
+
+        requests:
+            A list of (resource_name, is_read, num_reqs, data_size) tuples.
+
+        priority:
+            The priority of the batch as a whole (see access_context()).
+
+        Note: The items are granted all at once, only when all of them fit.
+              (The batch never holds some of its resources while waiting for the rest.)
+        """
+        return _ResourceManagerClient.BatchAccessContext(self, requests, priority)
 
     def reconfigure_server(self, config):
-        jsonschema.validate(config, ConfigSchema)
-        self._commsocket.send_json( { "type": "config",
-                                      "config": config } )
-        response = self._recv_json_safe()
+        _CONFIG_VALIDATOR.validate(config)
+        self._config_cache = (0.0, None)
+        self._send({ "type": "config",
+                     "config": config })
+        response = self._recv_json_safe(REPLY_TIMEOUT_MS)
         if response != config:
             raise RuntimeError("Server failed to apply the new config")
 
     def read_config(self):
-        self._commsocket.send_json( { "type": "read-config" } )
-        response = self._recv_json_safe()
+        self._send({ "type": "read-config" })
+        response = self._recv_json_safe(REPLY_TIMEOUT_MS)
         if response["type"] != "read-config":
             raise RuntimeError(f"Bad response from resource manager server: {response}")
         return response["config"]
 
+    def _cached_read_config(self, ttl=5.0):
+        """
+        Like read_config(), but if the config was read within
+        the last ttl seconds, return that copy instead.
+        """
+        return self._cached_config(ttl) or self._cache_config(self.read_config())
+
     def __getstate__(self):
         """
         Pickle support.
         """
-        assert not self._currently_accessing, \
+        assert self._accessing_thread is None, \
             "Not allowed to pickle _ResourceManagerClient while an AcessContext is active."
         d = self.__dict__.copy()
         d['_context'] = None
         d['_commsocket'] = None
+        d['_dispatcher'] = None
         d['_poller'] = None
         return d
     
     def __setstate__(self, state):
+        """
+        Pickle support.
+        The sockets aren't created until the client is actually used,
+        since unpickled clients are often never used at all.
+        """
         self.__dict__.update(state)
-        self._initialize_zmq()
 
-    def _recv_json_safe(self, timeout_ms=4000):
+    def _begin_access(self):
+        """
+        Mark this client as accessing a resource, and return a token for _end_access().
+        It's a mistake to enter a second AccessContext with the same client,
+        either nested (in the same thread or task) or in parallel (from another thread).
+        """
+        active = _active_clients.get()
+        assert id(self) not in active, \
+            "Not allowed to use AccessContext in parallel or (nested)"
+        assert self._accessing_thread is None, \
+            "Not allowed to use AccessContext in parallel (from multiple threads)"
+        self._accessing_thread = threading.get_ident()
+        return _active_clients.set(active | {id(self)})
+
+    def _end_access(self, token):
+        _active_clients.reset(token)
+        self._accessing_thread = None
+
+    def _get_dispatcher(self):
+        # If the dispatcher's background thread died, switch to a new dispatcher.
+        dispatcher = self._dispatcher
+        if dispatcher._error is not None:
+            dispatcher.release()
+            dispatcher = self._dispatcher = _WaitDispatcher.acquire(self.server_ip, self.server_port)
+        return dispatcher
+
+    def _ensure_connected(self):
+        if self._commsocket is None:
+            self._initialize_zmq()
+
+    def _send(self, msg):
+        """
+        Send a json message to the server, tagged with a new message tag.
+        (orjson is faster than the stdlib json module used by send_json().)
+        """
+        self._send_raw(orjson.dumps(msg))
+
+    def _send_raw(self, payload):
+        """
+        Send an already-encoded message to the server, tagged with a new message tag.
         """
-        Receive a json message from the socket,
-        or if the server sends no response at all,
+        self._ensure_connected()
+        self._message_count += 1
+        self._message_tag = b"%d" % self._message_count
+        self._commsocket.send_multipart([self._message_tag, b"", payload])
+
+    def _recv_json_safe(self, timeout_ms=None):
+        """
+        Receive the reply to our most recent message from the socket,
+        or if the server sends no response within the timeout,
         raise a TimeoutError (rather than hanging indefinitely).
         
         timeout_ms:
-            How long the poller should wait to receive the reply from the server,
-            which might be busy with other clients and therefore take a while to respond.
-            When there are 1000 clients, a timeout of 2 seconds seems to be too short,
-            but 4 seconds is enough. For 2000 clients, 4 seconds is still too short.
-        """
-        events = dict(self._poller.poll(timeout_ms))
-        if events.get(self._commsocket, None):
-            return self._commsocket.recv_json()
-        else:
-            # With paired REQ (client) and REP (server) sockets,
-            # It's forbidden to call recv again if you haven't received a reply.
-            # We must reinitialize the socket before trying again.
-            # http://zguide.zeromq.org/page%3aall#Client-Side-Reliability-Lazy-Pirate-Pattern
-            # http://zguide.zeromq.org/py:lpclient
-            self._close_socket()
-            self._init_socket()
-            raise TimeoutError(f"Timed out after {timeout_ms/1000} seconds")
+            How long the poller should wait to receive the reply from the server.
+            If None, block until the reply arrives (without any periodic wakeups).
+            Callers that expect a prompt reply should pass REPLY_TIMEOUT_MS.
+        """
+        if timeout_ms is not None:
+            deadline = time.monotonic() + timeout_ms / 1000
+
+        while True:
+            # Fast path: If the reply has already arrived, there's no need to poll.
+            try:
+                tag, _empty, payload = self._commsocket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                if timeout_ms is None:
+                    remaining_ms = None
+                else:
+                    remaining_ms = max(0, 1000 * (deadline - time.monotonic()))
+                if not self._poller.poll(remaining_ms):
+                    raise TimeoutError(f"Timed out after {timeout_ms/1000} seconds")
+                continue
+
+            if tag == self._message_tag:
+                return orjson.loads(payload)
+
+            # Otherwise, this is a late reply to an earlier message
+            # (which timed out), so discard it and keep waiting.
     
-    def _attempt_acquire(self, resource_name, is_read, num_reqs, data_size):
+    def _attempt_acquire(self, resource_name, is_read, num_reqs, data_size, priority=0):
         """
         Attempt to acquire the given resource from the resource manager.
         If it is currently available, we will be the owner (we acquired it).
         if it isn't, we will have to wait, using the ID in the server response.
         
-        Returns (request_id, acquired)
+        Returns (request_id, acquired, hold_required)
+
+        hold_required:
+            If False, the server does not expect a 'hold' message after it
+            grants us access. (Older servers always expect one.)
         """
-        req_data = {
-            "type": "request",
-            "resource": resource_name,
-            "read": is_read,
-            "numopts": num_reqs,
-            "datasize": data_size
-        }
+        req_data = self._request_msg
+        req_data["resource"] = resource_name
+        req_data["read"] = is_read
+        req_data["numopts"] = num_reqs
+        req_data["datasize"] = data_size
+        req_data["priority"] = priority
         if self._debug:
-            jsonschema.validate(req_data, RequestMessageSchema)
+            self._validate(req_data, _check_request_message, _REQUEST_VALIDATOR)
         
-        self._commsocket.send_json( req_data )
-        response = self._recv_json_safe()
+        self._send(req_data)
+        response = self._recv_json_safe(REPLY_TIMEOUT_MS)
         if 'invalid' in response:
-            config = self.read_config()
-            msg = (
-                "Cannot acquire access to the shared resource because "
-                "your request exceeds the server's config maximums.\n"
-                f"Config maximums: {json.dumps(config)}\n"
-                f"Your request: {json.dumps(req_data)}")
-            raise RuntimeError(msg)
-        return (response["id"], response["available"])
+            self._raise_exceeds_config(req_data)
+        if 'rejected' in response:
+            raise _unavailable_error(req_data)
+        return (response["id"], response["available"], not response.get("skip_hold_ack", False))
     
-    def _wait_for_acquire(self, request_id):
-        sub_socket = self._context.socket(zmq.SUB)
-        sub_socket.setsockopt(zmq.SUBSCRIBE, str(request_id).encode('utf-8'))
-        sub_port = self.server_port + 1
-        sub_socket.connect(f'tcp://{self.server_ip}:{sub_port}')
-        with closing( sub_socket ):
-            # Wait happens here:
-            # We won't receive anything until the server grants us access to the resource.
-            sub_socket.recv()
-
-        msg = { "type": "hold", "id": request_id }
+    def _raise_exceeds_config(self, req_data):
+        # In case many requests are rejected in quick succession,
+        # avoid re-reading the config from the server every time.
+        raise _exceeds_config_error(self._cached_read_config(), req_data)
+
+    def _attempt_acquire_batch(self, requests, priority=0):
+        """
+        Send all of the given requests to the server in a single message.
+
+        Returns (request_ids, pending_ids), where pending_ids are
+        the ones we must wait for (via _wait_for_acquire_batch()).
+        """
+        req_data = {
+            "type": "batch-request",
+            "items": [ { "resource": resource_name,
+                         "read": bool(is_read),
+                         "numopts": int(num_reqs),
+                         "datasize": int(data_size) }
+                       for (resource_name, is_read, num_reqs, data_size) in requests ],
+            "priority": priority
+        }
+        if self._debug:
+            self._validate(req_data, _check_batch_request_message, _BATCH_REQUEST_VALIDATOR)
+
+        self._send(req_data)
+        response = self._recv_json_safe(REPLY_TIMEOUT_MS)
+        if 'invalid' in response:
+            self._raise_exceeds_config(req_data)
+        if 'rejected' in response:
+            raise _unavailable_error(req_data)
+
+        request_ids = [item["id"] for item in response["items"]]
+        pending_ids = [item["id"] for item in response["items"] if not item["available"]]
+        return (request_ids, pending_ids)
+
+    def _wait_for_acquire_batch(self, request_ids):
+        """
+        Wait until the server has published all of the given ids.
+        (The server never expects 'hold' messages for batch requests.)
+        """
+        self._get_dispatcher().wait([_grant_topic(request_id) for request_id in request_ids])
+
+    def _release_batch(self, request_ids):
+        msg = { "type": "batch-release", "ids": request_ids }
+        if self._debug:
+            self._validate(msg, _check_batch_release_message, _BATCH_RELEASE_VALIDATOR)
+        self._send(msg)
+        self._recv_json_safe(REPLY_TIMEOUT_MS)
+
+    def _wait_for_acquire(self, request_id, topic, hold_required=True):
+        """
+        Wait for the server to publish the given request's topic
+        (from _grant_topic()), which means we've been granted access.
+        """
+        # Wait happens here:
+        # We won't receive anything until the server grants us access to the resource.
+        self._get_dispatcher().wait([topic])
+
+        if not hold_required:
+            # The server treats the publication itself as the grant,
+            # so we can skip the extra round-trip.
+            return
+
         if self._debug:
-            jsonschema.validate(msg, HoldMessageSchema)
+            self._validate({ "type": "hold", "id": request_id }, _check_hold_message, _HOLD_VALIDATOR)
 
-        self._commsocket.send_json( msg  )
-        self._recv_json_safe(None) # No timeout here: We could be waiting for a long time.
+        self._send_raw(_BINARY_MESSAGE.pack(_HOLD_OPCODE, request_id))
+        self._recv_json_safe() # No timeout here: We could be waiting for a long time.
 
     def _release(self, request_id):
-        msg = { "type": "release", "id": request_id }
         if self._debug:
-            jsonschema.validate(msg, ReleaseMessageSchema)
-        self._commsocket.send_json( msg )
-        self._recv_json_safe()
+            self._validate({ "type": "release", "id": request_id }, _check_release_message, _RELEASE_VALIDATOR)
+        self._send_raw(_BINARY_MESSAGE.pack(_RELEASE_OPCODE, request_id))
+        self._recv_json_safe(REPLY_TIMEOUT_MS)
 
     class AccessContext:
         """
         Context manager to obtain access to a resource upon entering the
         context and release it upon exiting the context.
         """
-        def __init__(self, client, resource_name, is_read, num_reqs, data_size):
+        def __init__(self, client, resource_name, is_read, num_reqs, data_size, priority=0):
             self.client = client
             self.request_id = None
+            self._topic = None
+            self._token = None
             self.resource_name = resource_name
             self.is_read = bool(is_read)
             self.num_reqs = int(num_reqs)
             self.data_size = int(data_size)
+            self.priority = int(priority)
 
         def __enter__(self):
-            assert not self.client._currently_accessing, \
-                "Not allowed to use AccessContext in parallel or (nested)"
-            self.client._currently_accessing = True
+            # This guard is only for catching mistakes during development,
+            # so it is compiled out entirely when python runs with -O.
+            if __debug__:
+                self._token = self.client._begin_access()
             try:
-                self.request_id, success = self.client._attempt_acquire(self.resource_name, self.is_read, self.num_reqs, self.data_size)
+                self.request_id, success, hold_required = \
+                    self.client._attempt_acquire(self.resource_name, self.is_read, self.num_reqs, self.data_size, self.priority)
                 if not success:
-                    self.client._wait_for_acquire(self.request_id)
+                    self._topic = _grant_topic(self.request_id)
+                    self.client._wait_for_acquire(self.request_id, self._topic, hold_required)
             except BaseException:
-                self.client._currently_accessing = False
+                if __debug__:
+                    self.client._end_access(self._token)
                 raise
             return self
 
         def __exit__(self, *_args):
             self.client._release(self.request_id)
-            self.client._currently_accessing = False
+            if __debug__:
+                self.client._end_access(self._token)
+
+    class BatchAccessContext:
+        """
+        Context manager to obtain access to several resources upon entering
+        the context and release them all upon exiting the context.
+        Iterating over the context yields the server's request ids.
+        """
+        def __init__(self, client, requests, priority=0):
+            self.client = client
+            self.request_ids = []
+            self.requests = list(requests)
+            self.priority = int(priority)
+            self._token = None
+
+        def __iter__(self):
+            return iter(self.request_ids)
+
+        def __enter__(self):
+            # (Compiled out with -O; see AccessContext.__enter__)
+            if __debug__:
+                self._token = self.client._begin_access()
+            try:
+                self.request_ids, pending_ids = self.client._attempt_acquire_batch(self.requests, self.priority)
+                if pending_ids:
+                    self.client._wait_for_acquire_batch(pending_ids)
+            except BaseException:
+                if __debug__:
+                    self.client._end_access(self._token)
+                raise
+            return self
+
+        def __exit__(self, *_args):
+            self.client._release_batch(self.request_ids)
+            if __debug__:
+                self.client._end_access(self._token)
+
+
+class _AsyncResourceManagerClient(_ClientMixin):
+    """
+    An asyncio equivalent of _ResourceManagerClient.
+
+    Unlike _ResourceManagerClient, a single instance can be used for
+    any number of concurrent acquisitions, from any number of tasks.
+    Replies from the server are matched to their requests via the
+    message tag in each reply's envelope, and grant notifications
+    are matched to their requests via their topic.
+
+    Note: Like all zmq.asyncio sockets, this client must only be used
+          from a single event loop (and thread).  (But close() may be called
+          from any thread.)
+    """
+
+    def __init__(self, server_ip, server_port, _debug=False, _strict_debug=False):
+        """
+        _debug, _strict_debug: See _ResourceManagerClient.
+        """
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self._debug = _debug
+        self._strict_debug = _strict_debug
+        self._pid = os.getpid()
+
+        # The event loop we were most recently used from (see close()).
+        self._loop = None
+
+        # (timestamp, config) from _cached_read_config()
+        self._config_cache = (0.0, None)
+
+        self._context = zmq.asyncio.Context.instance()
+        self._commsocket = self._context.socket(zmq.DEALER)
+        self._commsocket.connect(f'tcp://{self.server_ip}:{self.server_port}')
+        self._sub_socket = self._context.socket(zmq.SUB)
+        self._sub_socket.connect(f'tcp://{self.server_ip}:{self.server_port + 1}')
+
+        self._message_count = 0
+        self._pending_replies = {} # tag -> Future
+        self._pending_grants = {}  # topic -> Future
+
+        # While a 'request' is awaiting its reply, further requests are
+        # buffered here (with a Future for each one's response),
+        # and then sent together in a single 'multi-request' (see _admit()).
+        self._admission_in_flight = False
+        self._buffered_requests = [] # [(request, Future)]
+        self._buffered_sender = None
+
+        # Background tasks which dispatch incoming messages
+        # to the above futures. (Started on first use.)
+        self._reply_reader = None
+        self._grant_reader = None
+
+        # Other background tasks (see _in_background()), e.g. releases on behalf of cancelled tasks
+        self._background_tasks = set()
+
+    def close(self):
+        """
+        Close the sockets and cancel the background tasks.
+        If our event loop is running (and this isn't it), the loop does this
+        on our behalf, since zmq.asyncio sockets and tasks belong to their loop.
+        """
+        if self._context is None:
+            return
+        loop = self._loop
+        if loop is not None and loop.is_running() and self._pid == os.getpid():
+            try:
+                current_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                current_loop = None
+            if current_loop is not loop:
+                loop.call_soon_threadsafe(self.close)
+                return
+
+        for task in (self._reply_reader, self._grant_reader, self._buffered_sender, *self._background_tasks):
+            if task is not None:
+                task.cancel()
+        if self._pid == os.getpid():
+            self._commsocket.close(linger=1000)
+            self._sub_socket.close(linger=0)
+        self._context = self._commsocket = self._sub_socket = None
+
+    def __del__(self):
+        if self._context is not None:
+            self.close()
+
+    def __getstate__(self):
+        raise TypeError("_AsyncResourceManagerClient cannot be pickled")
+
+    @asynccontextmanager
+    async def access_context(self, resource_name, is_read, num_reqs, data_size, priority=0):
+        """
+        Async context manager.
+        While the context is active, access is granted to the the requested resource.
+        """
+        request_id = await self._acquire(resource_name, bool(is_read), int(num_reqs), int(data_size), int(priority))
+        try:
+            yield
+        finally:
+            # (Shielded, so the release is still sent if this task is cancelled meanwhile.)
+            await asyncio.shield(self._in_background(self._release(request_id)))
+
+    async def read_config(self):
+        response = await self._request({ "type": "read-config" })
+        if response["type"] != "read-config":
+            raise RuntimeError(f"Bad response from resource manager server: {response}")
+        return response["config"]
+
+    async def _cached_read_config(self, ttl=5.0):
+        """
+        Like read_config(), but if the config was read within
+        the last ttl seconds, return that copy instead.
+        """
+        return self._cached_config(ttl) or self._cache_config(await self.read_config())
+
+    async def _request(self, msg, timeout_ms=REPLY_TIMEOUT_MS):
+        """
+        Send a json message to the server and return its reply.
+        If timeout_ms is None, wait indefinitely.
+        """
+        return await self._request_raw(orjson.dumps(msg), timeout_ms)
+
+    async def _request_raw(self, payload, timeout_ms=REPLY_TIMEOUT_MS):
+        """
+        Send an already-encoded message to the server and return its reply.
+        If timeout_ms is None, wait indefinitely.
+        """
+        # (The reader is restarted if it was cancelled, e.g. when a
+        # previous event loop was shut down by asyncio.run().)
+        if self._reply_reader is None or self._reply_reader.done():
+            self._reply_reader = asyncio.ensure_future(self._read_replies())
+
+        self._loop = loop = asyncio.get_running_loop()
+        self._message_count += 1
+        tag = b"%d" % self._message_count
+        reply = loop.create_future()
+        self._pending_replies[tag] = reply
+        try:
+            await self._commsocket.send_multipart([tag, b"", payload])
+            if timeout_ms is None:
+                return await reply
+            return await asyncio.wait_for(reply, timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out after {timeout_ms/1000} seconds")
+        finally:
+            del self._pending_replies[tag]
+
+    async def _read_replies(self):
+        while True:
+            tag, _empty, payload = await self._commsocket.recv_multipart()
+            reply = self._pending_replies.get(tag)
+            # If there's no future for this tag, it's a late reply
+            # to a message that timed out, so we discard it.
+            if reply is not None and not reply.done():
+                reply.set_result(orjson.loads(payload))
+
+    async def _read_grants(self):
+        while True:
+            msg = await self._sub_socket.recv()
+            grant = self._pending_grants.get(_published_topic(msg))
+            if grant is not None and not grant.done():
+                grant.set_result(None)
+
+    async def _acquire(self, resource_name, is_read, num_reqs, data_size, priority=0):
+        """
+        Acquire the given resource, waiting for it if necessary.
+        Returns the request id.
+        """
+        req_data = {
+            "type": "request",
+            "resource": resource_name,
+            "read": is_read,
+            "numopts": num_reqs,
+            "datasize": data_size,
+            "priority": priority,
+            "skip_hold_ack": True
+        }
+        if self._debug:
+            self._validate(req_data, _check_request_message, _REQUEST_VALIDATOR)
+
+        response = await self._admit(req_data)
+        if 'invalid' in response:
+            raise _exceeds_config_error(await self._cached_read_config(), req_data)
+        if 'rejected' in response:
+            raise _unavailable_error(req_data)
+
+        request_id = response["id"]
+        if response["available"]:
+            return request_id
+
+        topic, grant = self._subscribe_grant(request_id)
+        try:
+            # (Shielded, so cancelling this task doesn't cancel the grant.)
+            await asyncio.shield(grant)
+        except BaseException:
+            # The request is still queued on the server, so it will be granted eventually.
+            # Release it then, or else its resources would never be freed.
+            self._in_background(self._release_when_granted(request_id, topic, grant))
+            raise
+        self._unsubscribe_grant(topic)
+
+        if not response.get("skip_hold_ack", False):
+            if self._debug:
+                self._validate({ "type": "hold", "id": request_id }, _check_hold_message, _HOLD_VALIDATOR)
+            try:
+                await self._request_raw(_BINARY_MESSAGE.pack(_HOLD_OPCODE, request_id), None)
+            except BaseException:
+                # We were granted access, so it must be released.
+                self._in_background(self._release(request_id))
+                raise
+
+        return request_id
+
+    def _subscribe_grant(self, request_id):
+        """
+        Subscribe to the server's notification that the given request was granted.
+        Returns (topic, future), where the future completes when the grant arrives.
+        """
+        if self._grant_reader is None or self._grant_reader.done():
+            self._grant_reader = asyncio.ensure_future(self._read_grants())
+
+        topic = _grant_topic(request_id)
+        grant = asyncio.get_running_loop().create_future()
+        self._pending_grants[topic] = grant
+        self._sub_socket.setsockopt(zmq.SUBSCRIBE, topic)
+        return topic, grant
+
+    def _unsubscribe_grant(self, topic):
+        self._sub_socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+        del self._pending_grants[topic]
+
+    async def _release_when_granted(self, request_id, topic, grant):
+        """
+        Release a queued request (whose task was cancelled) once the server grants it.
+        """
+        try:
+            await grant
+        finally:
+            self._unsubscribe_grant(topic)
+        await self._release(request_id)
+
+    def _in_background(self, coro):
+        """
+        Run the given coroutine in a task which isn't cancelled along with the current task.
+        (We keep a reference to the task until it's done, as asyncio requires.)
+        """
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def _admit(self, req_data):
+        """
+        Send the given 'request' message and return the server's response.
+
+        If another request is already awaiting its reply, this one is buffered
+        along with any others that arrive in the meantime, and they are all sent
+        in a single 'multi-request' once that reply arrives.  So a burst of
+        concurrent acquisitions costs two round-trips rather than one per task.
+        """
+        if self._admission_in_flight:
+            response = asyncio.get_running_loop().create_future()
+            self._buffered_requests.append((req_data, response))
+        else:
+            self._admission_in_flight = True
+            response = asyncio.ensure_future(self._request(req_data))
+            response.add_done_callback(self._admission_done)
+
+        try:
+            # (Shielded, so cancelling this task doesn't discard the server's response.)
+            return await asyncio.shield(response)
+        except asyncio.CancelledError:
+            self._abandon_admission(response)
+            raise
+
+    def _admission_done(self, _request=None):
+        """
+        Called when a (multi-)request has received its reply (or failed).
+        Sends the next buffered requests, if any.
+        """
+        # Skip requests whose tasks were cancelled while they were buffered.
+        buffered = [(req_data, response) for (req_data, response) in self._buffered_requests
+                    if not response.done()]
+        self._buffered_requests = []
+        if buffered:
+            self._buffered_sender = asyncio.ensure_future(self._send_buffered_requests(buffered))
+        else:
+            self._admission_in_flight = False
+
+    def _abandon_admission(self, response):
+        """
+        Called when a task is cancelled while awaiting its response from _admit().
+        If its request hasn't been sent yet, it never will be.
+        Otherwise, whatever the server admits is released (once it's granted).
+        """
+        if any(r is response for (_, r) in self._buffered_requests):
+            response.cancel()
+        else:
+            response.add_done_callback(self._release_admitted)
+
+    def _release_admitted(self, response):
+        if response.cancelled() or response.exception() is not None:
+            return
+        reply = response.result()
+        if 'invalid' in reply or 'rejected' in reply:
+            return
+        request_id = reply["id"]
+        if reply["available"]:
+            self._in_background(self._release(request_id))
+        else:
+            topic, grant = self._subscribe_grant(request_id)
+            self._in_background(self._release_when_granted(request_id, topic, grant))
+
+    async def _send_buffered_requests(self, buffered):
+        try:
+            reply = await self._request({ "type": "multi-request",
+                                          "items": [req_data for (req_data, _) in buffered] })
+        except asyncio.CancelledError:
+            for _, response in buffered:
+                response.cancel()
+            raise
+        except Exception as ex:
+            for _, response in buffered:
+                if not response.done():
+                    response.set_exception(ex)
+        else:
+            for (_, response), item in zip(buffered, reply["items"]):
+                if not response.done():
+                    response.set_result(item)
+        finally:
+            self._admission_done()
+
+    async def _release(self, request_id):
+        if self._debug:
+            self._validate({ "type": "release", "id": request_id }, _check_release_message, _RELEASE_VALIDATOR)
+        await self._request_raw(_BINARY_MESSAGE.pack(_RELEASE_OPCODE, request_id))
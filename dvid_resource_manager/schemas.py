@@ -14,7 +14,15 @@ RequestMessageSchema = {
         "resource": { "type": "string" },
         "read": { "type": "boolean" },
         "numopts": { "type": "integer" },
-        "datasize": { "type": "integer" }
+        "datasize": { "type": "integer" },
+
+        # Optional. If the request must wait, it is granted ahead of
+        # waiting requests with lower priority (default: 0).
+        "priority": { "type": "integer" },
+
+        # If true, the client will not send a 'hold' message after it
+        # is notified (via the publisher socket) that it has been granted access.
+        "skip_hold_ack": { "type": "boolean" }
     }
 }
 
@@ -36,6 +44,50 @@ ReleaseMessageSchema = {
     }
 }
 
+BatchRequestItemSchema = {
+    "type": "object",
+    "required": ["resource", "read", "numopts", "datasize"],
+    "properties": {
+        "resource": { "type": "string" },
+        "read": { "type": "boolean" },
+        "numopts": { "type": "integer" },
+        "datasize": { "type": "integer" }
+    }
+}
+
+BatchRequestMessageSchema = {
+    "type": "object",
+    "required": ["type", "items"],
+    "properties": {
+        "type": { "type": "string", "enum": ["batch-request"] },
+        "items": { "type": "array", "items": BatchRequestItemSchema },
+
+        # Optional. The batch's items are granted together (when they all fit),
+        # so the batch has a single priority (default: 0).
+        "priority": { "type": "integer" }
+    }
+}
+
+# Several independent 'request' messages, sent together to save round-trips.
+# (Unlike a 'batch-request', each one is admitted just as if it had been sent alone.)
+MultiRequestMessageSchema = {
+    "type": "object",
+    "required": ["type", "items"],
+    "properties": {
+        "type": { "type": "string", "enum": ["multi-request"] },
+        "items": { "type": "array", "items": RequestMessageSchema }
+    }
+}
+
+BatchReleaseMessageSchema = {
+    "type": "object",
+    "required": ["type", "ids"],
+    "properties": {
+        "type": { "type": "string", "enum": ["batch-release"] },
+        "ids": { "type": "array", "items": { "type": "integer" } }
+    }
+}
+
 ConfigSchema = {
     "type": "object",
     "additionalProperties": False,
@@ -73,10 +125,43 @@ ReceivedMessageSchema = {
     "oneOf": [ RequestMessageSchema,
                HoldMessageSchema,
                ReleaseMessageSchema,
+               BatchRequestMessageSchema,
+               MultiRequestMessageSchema,
+               BatchReleaseMessageSchema,
                ConfigMessageSchema,
                ReadConfigMessageSchema ]
 }
 
+# Since each message's 'type' identifies its schema,
+# a message can be checked against just that one schema,
+# rather than against every schema in the 'oneOf' list above.
+ReceivedMessageSchemasByType = {
+    "request": RequestMessageSchema,
+    "hold": HoldMessageSchema,
+    "release": ReleaseMessageSchema,
+    "batch-request": BatchRequestMessageSchema,
+    "multi-request": MultiRequestMessageSchema,
+    "batch-release": BatchReleaseMessageSchema,
+    "config": ConfigMessageSchema,
+    "read-config": ReadConfigMessageSchema
+}
+
+
+##
+## Client -> Server (binary)
+##
+
+# Since 'hold' and 'release' messages are so frequent (and so simple),
+# clients send them in a compact binary form rather than as json:
+# a one-byte opcode followed by the request id (as a big-endian uint64,
+# the same encoding as the ids the server publishes).
+# (The server tells them apart from json messages, which always begin with '{'.)
+# If a binary message is malformed (wrong length or unknown opcode),
+# or its id isn't currently granted (e.g. it was already released),
+# the server replies with an 'error' (see HoldResponseSchema) and ignores it.
+BinaryMessageFormat = '>BQ'
+BinaryMessageOpcodes = { "hold": 0, "release": 1 }
+
 
 ##
 ## Server -> Client
@@ -91,7 +176,62 @@ RequestResponseSchema = {
     "required": ["id", "available"],
     "properties": {
         "id":  { "type": "integer" },
-        "available":  { "type": "boolean" }
+        "available":  { "type": "boolean" },
+        "invalid":  { "type": "boolean" },
+
+        # Included (true) if the request doesn't fit right now, and the server
+        # doesn't queue requests (it was started with --no-queuing).
+        # The id will never be published, and the request must not be released.
+        "rejected":  { "type": "boolean" },
+
+        # Included (true) if the server will not expect a 'hold' message
+        # for this request after it publishes the request's id.
+        "skip_hold_ack":  { "type": "boolean" }
+    }
+}
+
+BatchRequestResponseSchema = {
+    "$schema": "http://json-schema.org/schema#",
+    "title": "Response to a 'batch-request' request",
+
+    "type": "object",
+    "additionalProperties": False,
+    "properties": {
+        # One entry per requested item, in the same order as the request.
+        # (Batch clients never send 'hold', so 'skip_hold_ack' is implied.)
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["id", "available"],
+                "properties": {
+                    "id":  { "type": "integer" },
+                    "available":  { "type": "boolean" }
+                }
+            }
+        },
+
+        # Present (instead of 'items') if any item exceeds the config maximums.
+        "invalid": { "type": "boolean" },
+
+        # Present (instead of 'items') if any item doesn't fit right now,
+        # and the server doesn't queue requests (see RequestResponseSchema).
+        # None of the items were granted.
+        "rejected": { "type": "boolean" }
+    }
+}
+
+MultiRequestResponseSchema = {
+    "$schema": "http://json-schema.org/schema#",
+    "title": "Response to a 'multi-request' request",
+
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["items"],
+    "properties": {
+        # The response to each 'request', in the same order as the request.
+        "items": { "type": "array", "items": RequestResponseSchema }
     }
 }
 
@@ -108,7 +248,11 @@ HoldResponseSchema = {
     # Response is an empty object
     # (The act of sending the empty response tells the
     # client that the resource has been acquired.)
-    "properties": {}
+    # If the message was malformed (or its id isn't granted),
+    # the response has an error message instead.
+    "properties": {
+        "error": { "type": "string" }
+    }
 }
 
 ReleaseResponseSchema = {
@@ -119,5 +263,8 @@ ReleaseResponseSchema = {
     "additionalProperties": False,
 
     # Response is an empty object.
-    "properties": {}
+    # (Or an error message, as in HoldResponseSchema.)
+    "properties": {
+        "error": { "type": "string" }
+    }
 }
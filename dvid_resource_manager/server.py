@@ -24,21 +24,48 @@ are independent.  It might make sense to make concurrent requests limits a serve
 # TODO: potentially time-out the pub/sub reservation
 
 import sys
-import json
-import copy
+import time
+import struct
 import signal
 import argparse
+import selectors
+from heapq import heappush, heappop, heapify
 from collections import deque
+from pathlib import Path
 
+import orjson
 import jsonschema
 
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
 import zmq
 
-from dvid_resource_manager.schemas import ReceivedMessageSchema
+from dvid_resource_manager.schemas import ( ReceivedMessageSchema, ReceivedMessageSchemasByType,
+                                             BinaryMessageFormat, BinaryMessageOpcodes )
 
 # poll delay when un-acked pub 
 PUBDELAY = 2000 # ms
 
+# high-water mark (max queued messages per peer) for the server's sockets
+# (higher than zmq's default, to absorb bursts from many clients)
+SOCKET_HWM = 10000
+
+# pre-serialized empty response (for hold, release, etc.)
+EMPTY_RESPONSE = orjson.dumps({})
+MALFORMED_BINARY_RESPONSE = orjson.dumps({"error": "Malformed binary message"})
+UNKNOWN_ID_RESPONSE = orjson.dumps({"error": "Unknown id (not granted, or already released)"})
+
+# Each client id is a slot in current_work_items (the low bits)
+# plus the number of times that slot has been reused (the high bits),
+# so a stale message about a released id can't affect the slot's next owner.
+ID_SLOT_BITS = 32
+ID_SLOT_MASK = (1 << ID_SLOT_BITS) - 1
+ID_GENERATION = 1 << ID_SLOT_BITS
+MAX_ID = (1 << 64) - 1 # ids are published as 8 bytes
+
 DEFAULT_CONFIG = {
     "read_reqs": 128, # some multiple of the available worker threads in DVID
     "read_data": 1e12, # in bytes
@@ -46,6 +73,68 @@ DEFAULT_CONFIG = {
     "write_data": 1e12 # in bytes
 }
 
+# every config must have exactly these keys
+CONFIG_KEYS = frozenset(DEFAULT_CONFIG)
+
+def config_caps(config):
+    """
+    Return the config maximums as a tuple, in the same order
+    as the per-resource stats: (read_reqs, read_data, write_reqs, write_data)
+    """
+    return (config["read_reqs"], config["read_data"], config["write_reqs"], config["write_data"])
+
+# Bits (one per stat, in the same order as the stats) which indicate
+# that a resource's usage has reached the config maximum for that stat.
+READ_REQS_FULL, READ_DATA_FULL, WRITE_REQS_FULL, WRITE_DATA_FULL = 1, 2, 4, 8
+
+def saturation_bits(stats, caps):
+    """
+    Return the bits for each of the given stats which has reached its maximum.
+    """
+    return ( (READ_REQS_FULL if stats[0] >= caps[0] else 0)
+           | (READ_DATA_FULL if stats[1] >= caps[1] else 0)
+           | (WRITE_REQS_FULL if stats[2] >= caps[2] else 0)
+           | (WRITE_DATA_FULL if stats[3] >= caps[3] else 0) )
+
+def blocking_bits(request):
+    """
+    Return the saturation bits which, if any are set for the request's resource,
+    mean that the request can't possibly fit (because it would add to a stat that's already full).
+    """
+    if request["read"]:
+        return ( (READ_REQS_FULL if request["numopts"] > 0 else 0)
+               | (READ_DATA_FULL if request["datasize"] > 0 else 0) )
+    return ( (WRITE_REQS_FULL if request["numopts"] > 0 else 0)
+           | (WRITE_DATA_FULL if request["datasize"] > 0 else 0) )
+
+def compile_validator(schema):
+    """
+    Return a function which validates a message against the given schema.
+    Uses fastjsonschema (which generates specialized python code for the schema)
+    if it's available, or else a jsonschema validator (built just once).
+    """
+    if fastjsonschema is not None:
+        return fastjsonschema.compile(schema)
+    jsonschema.Draft7Validator.check_schema(schema)
+    return jsonschema.Draft7Validator(schema).validate
+
+# used in debug mode
+validate_any_message = compile_validator(ReceivedMessageSchema)
+message_validators = { msg_type: compile_validator(schema)
+                       for msg_type, schema in ReceivedMessageSchemasByType.items() }
+
+def validate_message(request):
+    """
+    Validate the message against the schema for its type.
+    """
+    try:
+        validator = message_validators[request["type"]]
+    except (TypeError, KeyError):
+        # Malformed message or unknown type.
+        # Check against all schemas to produce an appropriate error.
+        validator = validate_any_message
+    validator(request)
+
 def main():
     # Terminate results in normal shutdown
     signal.signal(signal.SIGTERM, lambda signum, stack_frame: sys.exit(0))
@@ -54,6 +143,9 @@ def main():
     parser.add_argument("comm_port", type=int, help="Port to use for listening . The next port (+1) will also be used, for publishing.")
     parser.add_argument("--config-file")
     parser.add_argument("--debug", action='store_true')
+    parser.add_argument("--no-queuing", action='store_true',
+                        help="Reject requests that can't be granted immediately, rather than queuing them. "
+                             "(The client raises an error instead of waiting.)")
     args = parser.parse_args()
 
     comm_port = args.comm_port
@@ -65,15 +157,15 @@ def main():
     # dict for current config
     # TODO: allow per resource config along with master config
     if args.config_file:
-        config = json.load(open(args.config_file, 'r'))
+        config = orjson.loads(Path(args.config_file).read_bytes())
     else:
         config = DEFAULT_CONFIG
 
-    if set(config.keys()) != set(DEFAULT_CONFIG.keys()):
+    if config.keys() != CONFIG_KEYS:
         sys.stderr.write("Config file does not have the expected keys!\n")
         sys.exit(1)
 
-    server = ResourceManagerServer(comm_port, pub_port, config)
+    server = ResourceManagerServer(comm_port, pub_port, config, enable_queuing=not args.no_queuing)
 
     try:
         server.run(args.debug)
@@ -82,187 +174,707 @@ def main():
 
 class ResourceManagerServer(object):
 
-    # stats unique per server
-    # (does not distinguish between dvids on different ports)
-    class ServerStats(object):
-        def __init__(self):
-            self.read_reqs = 0
-            self.read_data = 0
-            self.write_reqs = 0
-            self.write_data = 0
-
-    def __init__(self, comm_port, pub_port, config):
+    def __init__(self, comm_port, pub_port, config, enable_queuing=True):
         self.comm_port = comm_port
         self.pub_port = pub_port
         self.config = config
 
+        # If False, requests that don't fit are rejected rather than queued,
+        # so nothing is ever published (or republished).
+        self.enable_queuing = enable_queuing
+
+    @property
+    def config(self):
+        return self._config
+
+    # Also cache the config maximums as a tuple, for try_reserve()
+    @config.setter
+    def config(self, config):
+        self._config = config
+        self.config_caps = config_caps(config)
+
     def run(self, debug):
+        # stats unique per server (resource name -> [read_reqs, read_data, write_reqs, write_data])
+        # (does not distinguish between dvids on different ports)
+        # Each request only touches one resource's row, and for a 4-element row,
+        # plain python ints are much cheaper than numpy array operations.
+        # (The scan over queued work skips full resources via saturation_bits() instead.)
         self.resource_limits = {}
         
-        # outstanding work (client id -> request)
-        self.current_work_items = {}
+        # outstanding work, indexed by client id slot (see ID_SLOT_MASK)
+        # (None for ids which are queued, not yet granted)
+        self.current_work_items = []
+
+        # the current client id for each slot
+        self.slot_ids = []
+
+        # slots which have been released and can be reused (with a new id).
+        # They are reused oldest-first, so the set of subscribed ids
+        # doesn't keep growing with stale subscriptions.
+        self.free_ids = deque()
+
+        # pub message for each slot's current client id (the id as 8 big-endian bytes).
+        self.id_frames = []
         
         # datastructure for outstanding requests []{type, size, priority, client#, requests, etc -- can be greater than 1 but default 1, etc}
-        self.work_items = deque() # store data as (priority, request_info) -- use simple FIFO for now but could sort on priority if given)
+        # resource name -> {blocking_bits: heap of (-priority, seq, request_info)}: highest priority first, then FIFO.
+        # (Resources have independent quotas, so each one's queues are only scanned when its own work is released.
+        # Requests with the same blocking_bits() are queued together, so that while their resource is full,
+        # they can all be skipped at once, without trying each one.)
+        self.work_items = {}
+        self.work_seq = 0 # increment for each queued request (or batch)
+
+        # Batches which are waiting (as a unit) until all of their items fit.
+        # A heap of (-priority, seq, items, {resource name: blocking_bits() of its items}):
+        # highest priority first, then FIFO.
+        self.waiting_batches = []
         
         # create server to listen to provided port
-        context = zmq.Context()
-        comm_socket = context.socket(zmq.REP)
+        # (The server's own loop is the bottleneck, not zmq's I/O, so one I/O thread is plenty.
+        # We use a private context, rather than Context.instance(), since we terminate it on exit.
+        # Note: libzmq always disables Nagle's algorithm on its TCP sockets, so small replies
+        # aren't delayed, and there's no TCP_NODELAY option to set.)
+        context = zmq.Context(io_threads=1)
+        # ROUTER (rather than REP), so we aren't forced into strict recv/send lockstep.
+        # Each request's envelope (the client's identity and any delimiter frames)
+        # is echoed back with its reply, so both REQ and DEALER clients are supported.
+        comm_socket = context.socket(zmq.ROUTER)
+        comm_socket.setsockopt(zmq.RCVHWM, SOCKET_HWM)
+        comm_socket.setsockopt(zmq.SNDHWM, SOCKET_HWM)
+        comm_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
         comm_socket.bind("tcp://*:%s" % self.comm_port)
         
         # create publisher port
-        pub_socket = context.socket(zmq.PUB)
+        # (Pub messages are republished until acknowledged,
+        # so there's no need to linger on them at shutdown.)
+        # XPUB (rather than PUB) lets us see each client's subscriptions,
+        # so we can resend a grant immediately if it was published before
+        # the client subscribed, rather than waiting for the next republish.
+        # (VERBOSE, so we see every subscription, even for a topic that's already subscribed.)
+        pub_socket = context.socket(zmq.XPUB)
+        pub_socket.setsockopt(zmq.XPUB_VERBOSE, 1)
+        pub_socket.setsockopt(zmq.SNDHWM, SOCKET_HWM)
+        pub_socket.setsockopt(zmq.LINGER, 0)
+        pub_socket.setsockopt(zmq.IMMEDIATE, 1)
+        pub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
         pub_socket.bind("tcp://*:%s" % self.pub_port)
         
-        # create poller 
-        poller = zmq.Poller()
-        poller.register(comm_socket, zmq.POLLIN)
+        # Wait for requests via the OS's native event mechanism (e.g. epoll) on the socket's FD,
+        # which is registered once, rather than rebuilding a poll set for every zmq.Poller.poll().
+        # Note: The zmq FD is edge-triggered: it only signals that the socket's state
+        # *may* have changed, so we must check zmq.EVENTS before waiting on it.
+        selector = selectors.DefaultSelector()
+        selector.register(comm_socket.getsockopt(zmq.FD), selectors.EVENT_READ)
+        selector.register(pub_socket.getsockopt(zmq.FD), selectors.EVENT_READ)
         
         # !! PROBLEMS: if server gets an error can I gracefully unlock or reply; is it problematic that I require the client to respond to pub
             
-        clientid = 0 # increment for each resource request
-        
-        publish_list = set()
+        self.comm_socket = comm_socket
+        self.pub_socket = pub_socket
+
+        # names of the resources whose work has been released,
+        # until their queues have been re-scanned (see grant_released_work())
+        self.released_resources = set()
+
+        # client id -> pub message (from id_frames)
+        # (A dict gives O(1) insert/remove and a stable iteration order for republishing.
+        # Each id is published as a separate message, never batched into one buffer:
+        # subscribers rely on zmq's topic filtering to receive only their own ids.
+        # Consecutive sends are coalesced by zmq's I/O thread anyway.)
+        self.publish_list = publish_list = {}
+
+        # ids which have been subscribed to since they were (re)assigned.
+        # The subscription and request sockets are separate connections, so an unsubscription
+        # can arrive after its id has been released and reassigned.  Since reassignment removes
+        # the id from this set, such a stale unsubscription is ignored (see new_client_id()).
+        self.subscribed_ids = subscribed_ids = set()
+
+        # request type -> handler(envelope, request)
+        handlers = {
+            "request": self.handle_request,
+            "hold": self.handle_hold,
+            "release": self.handle_release,
+            "batch-request": self.handle_batch_request,
+            "multi-request": self.handle_multi_request,
+            "batch-release": self.handle_batch_release,
+            "config": self.handle_config,
+            "read-config": self.handle_read_config,
+        }
+
+        # opcode -> handler(envelope, id), for binary messages
+        binary_handlers = [None] * len(BinaryMessageOpcodes)
+        binary_handlers[BinaryMessageOpcodes["hold"]] = self.hold
+        binary_handlers[BinaryMessageOpcodes["release"]] = self.release
+        binary_types = {opcode: name for name, opcode in BinaryMessageOpcodes.items()}
+
+        # local names for everything used in the loop below (faster than attribute/global lookups)
+        select = selector.select
+        getsockopt = comm_socket.getsockopt
+        pub_getsockopt = pub_socket.getsockopt
+        pub_recv = pub_socket.recv
+        EVENTS = zmq.EVENTS
+        POLLIN = zmq.POLLIN
+        recv_multipart = comm_socket.recv_multipart
+        pub_send = pub_socket.send
+        loads = orjson.loads
+        binary_struct = struct.Struct(BinaryMessageFormat)
+        unpack_binary = binary_struct.unpack
+        binary_size = binary_struct.size
+        num_opcodes = len(binary_handlers)
+        # In production, skip validation without checking a flag for every message.
+        validate = validate_message if debug else (lambda request: None)
+        get_handler = handlers.get
+        NOBLOCK = zmq.NOBLOCK
+        DONTWAIT = zmq.DONTWAIT
+        Again = zmq.Again
+        monotonic = time.monotonic
+        republish_interval = PUBDELAY / 1000
+
+        # When the outstanding pubs are next due to be republished.
+        # This is a fixed schedule (while there's anything to republish),
+        # so a steady stream of requests can't postpone it indefinitely.
+        next_republish = None
 
         try:
 
             # infinite server loop
             while True:
-                # get next request
-                request = None
                 if len(publish_list) == 0:
-                    # block on next request
-                    request = comm_socket.recv_json()
+                    next_republish = None
                 else:
-                    # outstanding pubs not ack'd, poll for PUBDELAY and repub
-                    res = poller.poll(PUBDELAY)        
-                    if len(res) > 0:
-                        request = comm_socket.recv_json()
-                    else:
+                    now = monotonic()
+                    if next_republish is None:
+                        next_republish = now + republish_interval
+                    elif now >= next_republish:
+                        # outstanding pubs not ack'd after PUBDELAY
                         # republish in case dropped
-                        for cid in publish_list:
-                            pub_socket.send(b"%d %d" % (cid, 1))
+                        for frame in publish_list.values():
+                            pub_send(frame, DONTWAIT)
+                        next_republish = now + republish_interval
+
+                # wait for the next request(s) (or subscription(s))
+                requests_ready = getsockopt(EVENTS) & POLLIN
+                subscriptions_ready = pub_getsockopt(EVENTS) & POLLIN
+                if not (requests_ready or subscriptions_ready):
+                    if next_republish is None:
+                        # block on next request
+                        select()
+                    else:
+                        select(max(0.0, next_republish - monotonic()))
+                    continue
+
+                # If a client subscribes to an id we've already published,
+                # it missed the first publication, so send it again now.
+                # When a client unsubscribes, it has received its grant (or given up),
+                # which is as good as a 'hold': there's no need to keep republishing.
+                # (Subscription messages are b'\x01' + topic; unsubscriptions are b'\x00' + topic.)
+                while subscriptions_ready:
+                    try:
+                        msg = pub_recv(NOBLOCK)
+                    except Again:
+                        break
+                    if len(msg) != 9:
+                        continue
+                    cid = int.from_bytes(msg[1:], "big")
+                    if msg[0] == 1:
+                        subscribed_ids.add(cid)
+                        frame = publish_list.get(cid)
+                        if frame is not None:
+                            pub_send(frame, DONTWAIT)
+                    elif cid in subscribed_ids:
+                        subscribed_ids.discard(cid)
+                        publish_list.pop(cid, None)
+
+                # process every queued request before polling again
+                while True:
+                    try:
+                        frames = recv_multipart(NOBLOCK)
+                    except Again:
+                        break
+
+                    envelope = frames[:-1]
+                    payload = frames[-1]
+
+                    if not payload.startswith(b"{"):
+                        # binary 'hold' or 'release'
+                        if len(payload) != binary_size or payload[0] >= num_opcodes:
+                            comm_socket.send_multipart([*envelope, MALFORMED_BINARY_RESPONSE])
+                            continue
+                        opcode, cid = unpack_binary(payload)
+                        if debug:
+                            validate({"type": binary_types[opcode], "id": cid})
+                        binary_handlers[opcode](envelope, cid)
                         continue
+
+                    request = loads(payload)
             
-                if debug:
-                    jsonschema.validate(request, ReceivedMessageSchema)
+                    validate(request)
                 
-                # process request
-                if request["type"] == "request":
-                    # request for resource
-                    request["id"] = clientid
-                    clientid += 1
-
-                    # Check to see if the request is larger than the default maximums,
-                    # which would imply that it can NEVER be satisfied,
-                    # regardless of current resource usage levels.
-                    if not self.is_available(request, None):
-                        comm_socket.send_json({"available": False, "invalid": True, "id": request["id"]})
-                    elif self.request_resource(request):
-                        # resource available
-                        comm_socket.send_json({"available": True, "id": request["id"]})
-                    else:
-                        # give everything the same priority now
-                        # TODO: allow optional priority and sort work items accordingly
-                        self.work_items.append((0, request))
-                        comm_socket.send_json({"available": False, "id": request["id"]})
-                elif request["type"] == "hold":
-                    # grab resource, removed from pub list
-                    publish_list.remove(request["id"])
-                    comm_socket.send_json({})
-                elif request["type"] == "release":
-                    self.finish_work(request["id"])
-                    comm_socket.send_json({})
-            
-                    # find work and publish
-                    while len(self.work_items) > 0: 
-                        cid = self.find_work()
-                        if cid != -1:
-                            publish_list.add(cid)
-                            pub_socket.send(b"%d %d" % (cid, 1))
-                        else:
-                            break 
-                elif request["type"] == "config":
-                    # reset config
-                    self.config = request["config"]
-                    comm_socket.send_json(request["config"])
-                elif request["type"] == "read-config":
-                    comm_socket.send_json({"type": "read-config", "config": self.config})
-                else:
-                    comm_socket.send_json({})
-                    raise Exception("Unknown request type")
+                    # process request
+                    handler = get_handler(request["type"])
+                    if handler is None:
+                        comm_socket.send_multipart([*envelope, EMPTY_RESPONSE])
+                        raise Exception("Unknown request type")
+                    handler(envelope, request)
+
+                # grant queued work once per burst of releases, rather than after each one
+                self.grant_released_work()
         finally:
+            selector.close()
             comm_socket.setsockopt(zmq.LINGER, 1000) # timeout of 1 second
             comm_socket.close()
-            poller.unregister(comm_socket)
+            pub_socket.close()
             context.term()
 
+    def handle_request(self, envelope, request):
+        # queued work gets first dibs on anything that was released
+        self.grant_released_work()
+        self.comm_socket.send_multipart([*envelope, orjson.dumps(self.admit(request))])
+
+    def handle_multi_request(self, envelope, request):
+        # Several independent requests in one message.
+        # Each is admitted (or rejected) as if it had been sent alone.
+        self.grant_released_work()
+        admit = self.admit
+        responses = [admit(item) for item in request["items"]]
+        self.comm_socket.send_multipart([*envelope, orjson.dumps({"items": responses})])
+
+    # grant or queue (or reject) a single request, and return the response for the client
+    def admit(self, request):
+        # request for resource
+        request["id"] = cid = self.new_client_id()
+        request["stats"] = self.resource_stats(request["resource"])
+
+        # Check to see if the request is larger than the default maximums,
+        # which would imply that it can NEVER be satisfied,
+        # regardless of current resource usage levels.
+        if not self.is_available(request):
+            # The client won't release an invalid request, so its id can be reused.
+            self.free_ids.append(cid & ID_SLOT_MASK)
+            return {"available": False, "invalid": True, "id": cid}
+
+        if ( not self.is_preempted(request["resource"], -request.get("priority", 0), blocking_bits(request))
+             and self.request_resource(request) ):
+            # resource available
+            return {"available": True, "id": cid}
+
+        if not self.enable_queuing:
+            # The client won't wait for (or release) a rejected request.
+            self.free_ids.append(cid & ID_SLOT_MASK)
+            return {"available": False, "rejected": True, "id": cid}
+
+        self.enqueue_work(request)
+        if request.get("skip_hold_ack"):
+            # The client won't send 'hold' after we publish its id.
+            # We'll keep publishing until it sends 'release'.
+            return {"available": False, "id": cid, "skip_hold_ack": True}
+        return {"available": False, "id": cid}
+
+    def handle_hold(self, envelope, request):
+        self.hold(envelope, request["id"])
+
+    def handle_release(self, envelope, request):
+        self.release(envelope, request["id"])
+
+    def hold(self, envelope, cid):
+        if not self.is_granted(cid):
+            self.comm_socket.send_multipart([*envelope, UNKNOWN_ID_RESPONSE])
+            return
+
+        # grab resource, removed from pub list
+        # (unless the client's unsubscription already removed it)
+        self.publish_list.pop(cid, None)
+        self.comm_socket.send_multipart([*envelope, EMPTY_RESPONSE])
+
+    def release(self, envelope, cid):
+        if not self.is_granted(cid):
+            self.comm_socket.send_multipart([*envelope, UNKNOWN_ID_RESPONSE])
+            return
+
+        # If the client skipped the 'hold' message,
+        # its id is still in the publish list.
+        self.publish_list.pop(cid, None)
+        self.finish_work(cid)
+        self.comm_socket.send_multipart([*envelope, EMPTY_RESPONSE])
+
+    def handle_batch_request(self, envelope, request):
+        # Several requests in one message.
+        # If they could never be satisfied (all together),
+        # none of them are granted.
+        # Otherwise, they are all granted at once: either now, or after waiting as a unit.
+        # (A batch never holds some of its resources while it waits for the others,
+        # so batches which need the same resources can't deadlock each other.)
+        self.grant_released_work()
+
+        items = request["items"]
+        if not self.is_batch_valid(items):
+            self.comm_socket.send_multipart([*envelope, orjson.dumps({"invalid": True})])
+            return
+
+        for item in items:
+            item["id"] = self.new_client_id()
+            item["stats"] = self.resource_stats(item["resource"])
+
+            # Batch clients never send 'hold'
+            item["skip_hold_ack"] = True
+
+        # Waiting work with a higher priority (which needs any of the same stats) goes first.
+        resources = {}
+        for item in items:
+            resources[item["resource"]] = resources.get(item["resource"], 0) | blocking_bits(item)
+        neg_priority = -request.get("priority", 0)
+        preempted = any( self.is_preempted(resource, neg_priority, blocking)
+                         for resource, blocking in resources.items() )
+
+        if not preempted and self.reserve_batch(items):
+            available = True
+        elif not self.enable_queuing:
+            # The client won't wait for (or release) a rejected batch.
+            self.free_ids.extend(item["id"] & ID_SLOT_MASK for item in items)
+            self.comm_socket.send_multipart([*envelope, orjson.dumps({"rejected": True})])
+            return
+        else:
+            heappush(self.waiting_batches, (neg_priority, self.work_seq, items, resources))
+            self.work_seq += 1
+            available = False
+
+        responses = [{"available": available, "id": item["id"]} for item in items]
+        self.comm_socket.send_multipart([*envelope, orjson.dumps({"items": responses})])
+
+    def handle_batch_release(self, envelope, request):
+        # If any id is unknown, none of them are released.
+        is_granted = self.is_granted
+        if not all(is_granted(cid) for cid in request["ids"]):
+            self.comm_socket.send_multipart([*envelope, UNKNOWN_ID_RESPONSE])
+            return
+
+        for cid in request["ids"]:
+            self.publish_list.pop(cid, None)
+            self.finish_work(cid)
+        self.comm_socket.send_multipart([*envelope, EMPTY_RESPONSE])
+
+    def handle_config(self, envelope, request):
+        # reset config
+        self.config = request["config"]
+
+        # If any maximums were raised, queued work might fit now.
+        self.released_resources.update(self.work_items)
+        for entry in self.waiting_batches:
+            self.released_resources.update(entry[3])
+        self.comm_socket.send_multipart([*envelope, orjson.dumps(request["config"])])
+
+    def handle_read_config(self, envelope, request):
+        self.comm_socket.send_multipart([*envelope, orjson.dumps({"type": "read-config", "config": self.config})])
+
+    # the stats for the given resource (created on first use)
+    def resource_stats(self, resource):
+        try:
+            return self.resource_limits[resource]
+        except KeyError:
+            stats = self.resource_limits[resource] = [0, 0, 0, 0]
+            return stats
+
+    # Return True if work with the given (negated) priority and blocking_bits() for the given resource
+    # needs any of the stats that are needed by waiting work with a higher priority
+    # (queued requests or waiting batches), in which case it must wait, too.
+    def is_preempted(self, resource, neg_priority, blocking):
+        if self.is_queued_ahead(resource, neg_priority, blocking):
+            return True
+        for entry in self.waiting_batches:
+            if entry[0] < neg_priority and entry[3].get(resource, 0) & blocking:
+                return True
+        return False
+
+    # Like is_preempted(), but only considers queued requests (not waiting batches).
+    def is_queued_ahead(self, resource, neg_priority, blocking):
+        queues = self.work_items.get(resource)
+        if queues is None:
+            return False
+        for queue_blocking, queue in queues.items():
+            if queue[0][0] < neg_priority and queue_blocking & blocking:
+                return True
+        return False
+
     # TODO proper error handling, json schema request
-    # { type=request, resource, read=true|false, numopts, datasize, id (set by server) }
+    # { type=request, resource, read=true|false, numopts, datasize, id and stats (set by server) }
+    # (Each request keeps a reference to its resource's stats,
+    # so they aren't looked up by name every time it's tried or released.)
     def request_resource(self, request):
-        resourcename = request["resource"]
-        if resourcename not in self.resource_limits:
-            self.resource_limits[resourcename] = ResourceManagerServer.ServerStats()
-        stats = self.resource_limits[resourcename]
-    
-        if self.is_available(request, stats):
-            if request["read"]:
-                stats.read_reqs += request["numopts"]
-                stats.read_data += request["datasize"]
-            else:
-                stats.write_reqs += request["numopts"]
-                stats.write_data += request["datasize"]
-            self.current_work_items[request["id"]] = request 
+        if self.try_reserve(request, request["stats"]):
+            self.current_work_items[request["id"] & ID_SLOT_MASK] = request
             return True
-    
         return False
     
-    
     # resource is not available if any of the resources are completely used
     # probably overly simplistic but usually calls are in batches of reads and writes separately
-    def is_available(self, request, curr_stats=None):
-        if curr_stats:
-            new_stats = copy.copy(curr_stats)
-        else:
-            # Useful for validating that the request doesn't
-            # exceed the original config maximums.
-            new_stats = ResourceManagerServer.ServerStats()
+    # If the request fits, add it to the given stats (in-place) and return True.
+    def try_reserve(self, request, stats):
+        read_reqs, read_data, write_reqs, write_data = stats
+        max_read_reqs, max_read_data, max_write_reqs, max_write_data = self.config_caps
 
+        numopts = request["numopts"]
+        datasize = request["datasize"]
         if request["read"]:
-            new_stats.read_reqs += request["numopts"]
-            new_stats.read_data += request["datasize"]
+            read_reqs += numopts
+            read_data += datasize
         else:
-            new_stats.write_reqs += request["numopts"]
-            new_stats.write_data += request["datasize"]
-        return (    new_stats.read_reqs <= self.config["read_reqs"]
-                and new_stats.read_data <= self.config["read_data"]
-                and new_stats.write_reqs <= self.config["write_reqs"]
-                and new_stats.write_data <= self.config["write_data"] )
+            write_reqs += numopts
+            write_data += datasize
+
+        if (    read_reqs <= max_read_reqs
+            and read_data <= max_read_data
+            and write_reqs <= max_write_reqs
+            and write_data <= max_write_data ):
+            stats[:] = (read_reqs, read_data, write_reqs, write_data)
+            return True
+        return False
+
+    # Check that the request doesn't exceed the original config maximums
+    # (regardless of current resource usage levels).
+    def is_available(self, request):
+        max_read_reqs, max_read_data, max_write_reqs, max_write_data = self.config_caps
+        if request["read"]:
+            return request["numopts"] <= max_read_reqs and request["datasize"] <= max_read_data
+        return request["numopts"] <= max_write_reqs and request["datasize"] <= max_write_data
     
-    # grab next resource (just grab oldest one)
-    # TODO use priority to sort
-    def find_work(self):
-        priority, work_item = self.work_items[0]
-        self.work_items.popleft()
-        if self.request_resource(work_item):
-            return work_item["id"]
-        else:
-            self.work_items.appendleft((priority,work_item))
-            return -1
+    # check that a batch of requests doesn't exceed the config maximums
+    # (otherwise the batch's later items would wait for its earlier items forever)
+    def is_batch_valid(self, items):
+        batch_stats = {}
+        for item in items:
+            stats = batch_stats.setdefault(item["resource"], [0, 0, 0, 0])
+            if not self.try_reserve(item, stats):
+                return False
+        return True
+
+    # If all of the batch's items fit (together), grant them all and return True.
+    # Otherwise, grant none of them.
+    def reserve_batch(self, items):
+        batch_stats = {}
+        for item in items:
+            try:
+                stats = batch_stats[item["resource"]]
+            except KeyError:
+                stats = batch_stats[item["resource"]] = list(item["stats"])
+            if not self.try_reserve(item, stats):
+                return False
+
+        for resource, stats in batch_stats.items():
+            self.resource_limits[resource][:] = stats
+        for item in items:
+            self.current_work_items[item["id"] & ID_SLOT_MASK] = item
+        return True
+
+    # Releasing work doesn't immediately grant queued work:
+    # the queue is scanned once after each burst of messages is processed
+    # (or before the next request is admitted, so that queued work goes first).
+    # (Only the queues of the released resources are scanned:
+    # work queued for any other resource still can't fit.)
+    # (Waiting batches get first dibs on the released resources.)
+    def grant_released_work(self):
+        if self.released_resources:
+            released_resources = self.released_resources
+            self.released_resources = set()
+            if self.waiting_batches:
+                self.publish_available_batches(released_resources)
+            for resource in released_resources:
+                self.publish_available_work(resource)
+
+    # grant every waiting batch (which uses any of the given resources) that fits now,
+    # (highest priority first, then oldest first),
+    # and publish the ids of all of their items.
+    # (As in publish_available_work(), a batch is not granted any stats that are
+    # needed by a waiting batch or a queued request with a higher priority.)
+    def publish_available_batches(self, released_resources):
+        pub_send = self.pub_socket.send
+        publish_list = self.publish_list
+        id_frames = self.id_frames
+        is_queued_ahead = self.is_queued_ahead
+
+        # resource -> blocking_bits() needed by waiting batches with a higher priority
+        reserved = {}
+        level = None
+        level_waiting = {}
+
+        waiting_batches = self.waiting_batches
+        still_waiting = []
+        while waiting_batches:
+            entry = heappop(waiting_batches)
+            neg_priority, _, items, resources = entry
+            if neg_priority != level:
+                for resource, blocking in level_waiting.items():
+                    reserved[resource] = reserved.get(resource, 0) | blocking
+                level = neg_priority
+                level_waiting = {}
+
+            if ( not released_resources.isdisjoint(resources)
+                 and not any( reserved.get(resource, 0) & blocking or is_queued_ahead(resource, neg_priority, blocking)
+                              for resource, blocking in resources.items() )
+                 and self.reserve_batch(items) ):
+                for item in items:
+                    cid = item["id"]
+                    frame = publish_list[cid] = id_frames[cid & ID_SLOT_MASK]
+                    pub_send(frame)
+
+                # Queued requests for the batch's other resources may have been held back for it,
+                # so scan those, too.
+                released_resources.update(resources)
+            else:
+                still_waiting.append(entry)
+                for resource, blocking in resources.items():
+                    level_waiting[resource] = level_waiting.get(resource, 0) | blocking
+        self.waiting_batches = still_waiting
+
+    # queue a request which can't be granted yet
+    # (in the queue for its resource and blocking_bits(), for publish_available_work())
+    def enqueue_work(self, request):
+        entry = (-request.get("priority", 0), self.work_seq, request)
+        self.work_seq += 1
+        try:
+            queues = self.work_items[request["resource"]]
+        except KeyError:
+            queues = self.work_items[request["resource"]] = {}
+        try:
+            heappush(queues[blocking_bits(request)], entry)
+        except KeyError:
+            queues[blocking_bits(request)] = [entry]
+
+    # grant every item queued for the given resource that fits
+    # (highest priority first, then oldest first),
+    # and publish the ids of the newly granted items.
+    # Items that don't fit stay queued.
+    def publish_available_work(self, resource):
+        queues = self.work_items.pop(resource, None)
+        if queues is None:
+            return
+
+        request_resource = self.request_resource
+        caps = self.config_caps
+        pub_send = self.pub_socket.send
+        publish_list = self.publish_list
+        id_frames = self.id_frames
+
+        # A whole queue is stopped once its items are blocked by a full stat.
+        # (Recomputed whenever an item is granted.)
+        stats = self.resource_limits[resource]
+        saturated = saturation_bits(stats, caps)
+
+        # Items with a lower priority must not be granted any of the stats that are
+        # needed by waiting items with a higher priority, or else a large request could
+        # be starved by a stream of smaller ones with lower priority.
+        # reserved: the blocking_bits() of items which are still waiting, with a higher priority
+        #           than the current item. (Items with the same priority may still pass each other.)
+        reserved = 0
+        level = None # the current item's (negated) priority
+        level_waiting = 0 # the blocking_bits() of waiting items with that priority
+
+        # Waiting batches reserve stats the same way, against items with a lower priority:
+        # (negated priority, blocking_bits() of the batch's items for this resource), in order
+        batch_reservations = sorted( (entry[0], entry[3][resource])
+                                     for entry in self.waiting_batches if resource in entry[3] )
+        next_batch = 0
+
+        # Queues whose remaining items must all keep waiting
+        stopped = set()
+
+        # Items which were tried (in sorted order) but didn't fit, per queue
+        not_granted = {}
+        while True:
+            # Find the next item, among the queues which haven't been stopped
+            # (usually there are only one or two queues: reads and writes)
+            queue = None
+            for blocking, q in queues.items():
+                if q and blocking not in stopped and (queue is None or q[0] < queue[0]):
+                    queue = q
+                    queue_blocking = blocking
+            if queue is None:
+                break
+
+            if queue[0][0] != level:
+                # on to the next (lower) priority
+                reserved |= level_waiting
+                level = queue[0][0]
+                level_waiting = 0
+                while next_batch < len(batch_reservations) and batch_reservations[next_batch][0] < level:
+                    reserved |= batch_reservations[next_batch][1]
+                    next_batch += 1
+
+            if (saturated | reserved) & queue_blocking:
+                stopped.add(queue_blocking)
+                level_waiting |= queue_blocking
+                continue
+
+            entry = heappop(queue)
+            work_item = entry[2]
+            if request_resource(work_item):
+                saturated = saturation_bits(stats, caps)
+                cid = work_item["id"]
+                frame = publish_list[cid] = id_frames[cid & ID_SLOT_MASK]
+                pub_send(frame)
+            else:
+                level_waiting |= queue_blocking
+                try:
+                    not_granted[queue_blocking].append(entry)
+                except KeyError:
+                    not_granted[queue_blocking] = [entry]
+
+        # Return the items that didn't fit to their queues.
+        # (They came off the heap in sorted order, so if the rest of the queue was tried, too,
+        # they're already a valid heap.)
+        for blocking, entries in not_granted.items():
+            queue = queues[blocking]
+            if queue:
+                queue.extend(entries)
+                heapify(queue)
+            else:
+                queues[blocking] = entries
+
+        queues = { blocking: queue for blocking, queue in queues.items() if queue }
+        if queues:
+            self.work_items[resource] = queues
     
-    # resource finished    
+    # reuse a released slot if possible (with the slot's next id),
+    # otherwise add a new slot to current_work_items
+    def new_client_id(self):
+        if self.free_ids:
+            slot = self.free_ids.popleft()
+            self.subscribed_ids.discard(self.slot_ids[slot])
+            cid = self.slot_ids[slot] = (self.slot_ids[slot] + ID_GENERATION) & MAX_ID
+            self.id_frames[slot] = cid.to_bytes(8, "big")
+            return cid
+        cid = len(self.current_work_items)
+        self.current_work_items.append(None)
+        self.slot_ids.append(cid)
+        self.id_frames.append(cid.to_bytes(8, "big"))
+        return cid
+
+    # True if the given id is currently granted
+    # (not queued, already released, or reassigned, or otherwise unknown)
+    def is_granted(self, cid):
+        slot = cid & ID_SLOT_MASK
+        if slot >= len(self.current_work_items):
+            return False
+        request = self.current_work_items[slot]
+        return request is not None and request["id"] == cid
+
+    # resource finished (the id must be granted; see is_granted())
     def finish_work(self, curr_id):
-        request = self.current_work_items[curr_id]
-        del self.current_work_items[curr_id] 
-        stats = self.resource_limits[request["resource"]]
+        slot = curr_id & ID_SLOT_MASK
+        request = self.current_work_items[slot]
+        stats = request["stats"]
+        self.current_work_items[slot] = None
+        self.free_ids.append(slot)
+        self.released_resources.add(request["resource"])
      
         # update usage
+        numopts = request["numopts"]
+        datasize = request["datasize"]
         if request["read"]:
-            stats.read_reqs -= request["numopts"]
-            stats.read_data -= request["datasize"]
+            stats[0] -= numopts
+            stats[1] -= datasize
         else:
-            stats.write_reqs -= request["numopts"]
-            stats.write_data -= request["datasize"]
+            stats[2] -= numopts
+            stats[3] -= datasize
 
 if __name__ == "__main__":
     sys.exit( main() )
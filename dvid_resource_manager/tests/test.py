@@ -1,11 +1,15 @@
 import os
 import sys
-import json
 import time
+import asyncio
 import pickle
 import unittest
 import threading
 import subprocess
+from unittest import mock
+
+import zmq
+import orjson
 
 if __name__ == "__main__":
     # Make sure we're using the local version of the library,
@@ -13,61 +17,98 @@ if __name__ == "__main__":
     sys.path.insert(0, os.path.dirname(__file__) + '/../..')
 
 import dvid_resource_manager.server
-from dvid_resource_manager.client import ResourceManagerClient, TimeoutError
+from dvid_resource_manager.client import ResourceManagerClient, TimeoutError, ResourceUnavailableError, _WaitDispatcher
 from dvid_resource_manager.tests.helpers import _test_multiprocess
 
 SERVER_PORT = 3002
 
+# For the server started with --no-queuing
+NO_QUEUING_SERVER_PORT = 3004
+
+# Nothing listens on this port (for testing client timeouts).
+UNUSED_PORT = 3012
+
 def with_server(config_updates):
     """
     Decorator.
     
-    Launch the resource manager server with the given config.
+    Reconfigure the (already running) resource manager server with the given config.
     (Any keys missing in the config will be supplied from server.DEFAULT_CONFIG.)
     
-    Then run the decorated function, and kill the server after that function exits.
+    Then run the decorated test method, and verify that the server
+    is still running after that method exits.
     """
     server_config = dvid_resource_manager.server.DEFAULT_CONFIG.copy()
     server_config.update(config_updates)
     
     def decorator(func):
-        def wrapper( *args, **kwargs ):
-            server_config_path = '/tmp/test-resource-server-config.json'
-            with open(server_config_path, 'w') as f:
-                json.dump(server_config, f)
-    
-            server_script = dvid_resource_manager.server.__file__
-            cmd = f"{sys.executable} {server_script} {SERVER_PORT} --config-file={server_config_path} --debug"
-            server_process = subprocess.Popen(cmd, shell=True)
-
+        def wrapper( self, *args, **kwargs ):
+            client = ResourceManagerClient('127.0.0.1', self.server_port)
             try:
-                func(*args, **kwargs)
-                assert server_process.poll() is None, \
-                    f"Server exited prematurely with code {server_process.poll()}"
+                client.reconfigure_server(server_config)
             finally:
-                if server_process.poll() is None:
-                    server_process.kill()
-                    time.sleep(0.1)
-                    assert server_process.poll() is not None, \
-                        "Server process did not respond to SIGTERM"
-                os.unlink(server_config_path)
+                client.close()
+
+            func(self, *args, **kwargs)
+            assert self.server_process.poll() is None, \
+                f"Server exited prematurely with code {self.server_process.poll()}"
         return wrapper
     return decorator
 
 
-class Test(unittest.TestCase):
+class ServerTestCase(unittest.TestCase):
+    """
+    Base class for tests which share a single server,
+    launched with the class's server_args.
+    """
+    server_port = SERVER_PORT
+    server_args = []
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Launch one server for all of the tests.
+        Each test resets its config (see with_server()).
+        """
+        # Launch via main() rather than server.__file__, which might be a compiled (Cython) module.
+        server_main = "from dvid_resource_manager.server import main; main()"
+        cls.server_process = subprocess.Popen([sys.executable, '-c', server_main, str(cls.server_port), '--debug', *cls.server_args])
+
+        # Wait until the server is responding, so the tests don't have to.
+        client = ResourceManagerClient('127.0.0.1', cls.server_port)
+        try:
+            client.read_config()
+        except TimeoutError:
+            cls.tearDownClass()
+            raise
+        finally:
+            client.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server_process.poll() is None:
+            cls.server_process.terminate()
+            try:
+                cls.server_process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                cls.server_process.kill()
+                cls.server_process.wait()
+                raise AssertionError("Server process did not respond to SIGTERM")
+
+
+class Test(ServerTestCase):
     ##
     ## TODO: This test suite does not check the following:
     ##       - data size limits
     ##
-    
+
     @with_server({"write_reqs": 2})
     def test_1_basic(self):
         """
         Request access to a resource.
         """
         resource = 'my-resource'
-        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True, _strict_debug=True)
         assert client.read_config()["write_reqs"] == 2
         with client.access_context( resource, False, 1, 1000 ):
             pass
@@ -114,11 +155,6 @@ class Test(unittest.TestCase):
         resource = 'my-resource'
         DELAY = 0.5
 
-        # Without this sleep this test fails intermittently with a strange error.
-        # See https://github.com/janelia-flyem/DVIDResourceManager/issues/4
-        # Does the server need time to initialize?
-        time.sleep(0.5)
-        
         client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
         
         task_started = threading.Event()
@@ -184,7 +220,7 @@ class Test(unittest.TestCase):
 
 
     def test_9_timeout(self):
-        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client = ResourceManagerClient('127.0.0.1', UNUSED_PORT, _debug=True)
         try:
             client.read_config()
         except TimeoutError:
@@ -197,6 +233,764 @@ class Test(unittest.TestCase):
         _test_multiprocess(client)
 
 
+    @with_server({"read_reqs": 2})
+    def test_11_batch(self):
+        """
+        Acquire several resources at once, and verify that they are
+        not available to other clients until the batch is released.
+        """
+        resource = 'my-resource'
+        DELAY = 0.5
+
+        client_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        with self.assertRaisesRegex(RuntimeError, "request exceeds"):
+            with client_1.batch_access_context( [(resource, True, 1, 1000)]*3 ):
+                pass
+
+        task_started = threading.Event()
+        def long_task():
+            with client_1.batch_access_context( [(resource, True, 1, 1000)]*2 ) as batch:
+                assert len(list(batch)) == 2
+                task_started.set()
+                time.sleep(DELAY)
+
+        start = time.time()
+        th = threading.Thread(target=long_task)
+        th.start()
+
+        task_started.wait()
+        with client_2.batch_access_context( [(resource, True, 1, 1000), ('other-resource', True, 1, 1000)] ):
+            assert time.time() - start >= DELAY, \
+                "We shouldn't have been granted access to the resource so quickly!"
+
+        th.join()
+
+
+    @with_server({"read_reqs": 2})
+    def test_12_async(self):
+        """
+        Use a single client for many concurrent acquisitions via asyncio,
+        and verify that the server never grants more than allowed.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        active = 0
+        max_active = 0
+        async def task():
+            nonlocal active, max_active
+            async with client.access_context_async( resource, True, 1, 1000 ):
+                active += 1
+                max_active = max(active, max_active)
+                await asyncio.sleep(0.1)
+                active -= 1
+
+        async def main():
+            await asyncio.gather(*(task() for _ in range(6)))
+
+        start = time.time()
+        asyncio.run(main())
+        assert max_active == 2
+        assert time.time() - start >= 0.3, \
+            "We shouldn't have been granted access to the resource so quickly!"
+
+
+    @with_server({"read_reqs": 1})
+    def test_13_priority(self):
+        """
+        When several requests are waiting, the one with
+        the highest priority is granted first.
+        """
+        resource = 'my-resource'
+        client_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_3 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        granted = []
+        def waiting_task(client, name, priority):
+            with client.access_context( resource, True, 1, 1000, priority ):
+                granted.append(name)
+                time.sleep(0.1)
+
+        with client_1.access_context( resource, True, 1, 1000 ):
+            low = threading.Thread(target=waiting_task, args=(client_2, 'low', 0))
+            low.start()
+            time.sleep(0.2)
+            high = threading.Thread(target=waiting_task, args=(client_3, 'high', 10))
+            high.start()
+            time.sleep(0.2)
+
+        low.join()
+        high.join()
+        assert granted == ['high', 'low'], f"Requests were granted in the wrong order: {granted}"
+
+
+    @with_server({"read_reqs": 1})
+    def test_14_late_subscriber(self):
+        """
+        If a client subscribes after its request has already been granted
+        (and published), the server should resend the grant right away,
+        rather than waiting for its next periodic republish.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        context = zmq.Context()
+        comm_socket = context.socket(zmq.REQ)
+        comm_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT}')
+        sub_socket = context.socket(zmq.SUB)
+        try:
+            with client.access_context( resource, True, 1, 1000 ):
+                comm_socket.send(orjson.dumps({ "type": "request", "resource": resource,
+                                                "read": True, "numopts": 1, "datasize": 1000 }))
+                response = orjson.loads(comm_socket.recv())
+                assert not response["available"]
+
+            # Our request was granted (and published) when the context exited,
+            # but we weren't subscribed yet.
+            time.sleep(0.1)
+            start = time.time()
+            sub_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT+1}')
+            sub_socket.setsockopt(zmq.SUBSCRIBE, response["id"].to_bytes(8, "big"))
+            assert sub_socket.poll(1000), "Grant was not resent to the late subscriber"
+            assert sub_socket.recv() == response["id"].to_bytes(8, "big")
+            assert time.time() - start < dvid_resource_manager.server.PUBDELAY / 1000
+
+            # The server is shared with other tests, so give the resource back.
+            comm_socket.send(orjson.dumps({ "type": "release", "id": response["id"] }))
+            comm_socket.recv()
+        finally:
+            comm_socket.close(linger=0)
+            sub_socket.close(linger=0)
+            context.term()
+
+
+    @with_server({"read_reqs": 1})
+    def test_15_multi_request(self):
+        """
+        Send several independent requests in a single message.
+        Each is granted, queued, or rejected on its own.
+        """
+        resource = 'my-resource'
+        request = { "type": "request", "resource": resource,
+                    "read": True, "numopts": 1, "datasize": 1000 }
+        too_big = dict(request, numopts=2)
+
+        context = zmq.Context()
+        comm_socket = context.socket(zmq.REQ)
+        comm_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT}')
+        sub_socket = context.socket(zmq.SUB)
+        sub_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT+1}')
+        try:
+            comm_socket.send(orjson.dumps({ "type": "multi-request", "items": [request, too_big, request] }))
+            granted, invalid, queued = orjson.loads(comm_socket.recv())["items"]
+            assert granted["available"]
+            assert invalid["invalid"]
+            assert not queued["available"]
+
+            # The queued request is granted once the first one is released.
+            sub_socket.setsockopt(zmq.SUBSCRIBE, queued["id"].to_bytes(8, "big"))
+            comm_socket.send(orjson.dumps({ "type": "release", "id": granted["id"] }))
+            comm_socket.recv()
+            assert sub_socket.poll(1000), "Queued request was not granted"
+            sub_socket.recv()
+
+            comm_socket.send(orjson.dumps({ "type": "hold", "id": queued["id"] }))
+            comm_socket.recv()
+            comm_socket.send(orjson.dumps({ "type": "release", "id": queued["id"] }))
+            comm_socket.recv()
+        finally:
+            comm_socket.close(linger=0)
+            sub_socket.close(linger=0)
+            context.term()
+
+
+    @with_server({"read_reqs": 2})
+    def test_16_crossing_batches(self):
+        """
+        Two batches which need the same resources (in opposite order)
+        must not deadlock, even if only part of each one fits at first.
+        """
+        client_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_3 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        def batch_task(client, requests):
+            with client.batch_access_context(requests):
+                time.sleep(0.1)
+
+        batch_a = threading.Thread(target=batch_task, args=(client_1, [('r1', True, 1, 1000), ('r2', True, 2, 1000)]), daemon=True)
+        batch_b = threading.Thread(target=batch_task, args=(client_2, [('r2', True, 1, 1000), ('r1', True, 2, 1000)]), daemon=True)
+
+        # While r2 is partly in use, batch A's r1 item fits (but its r2 item doesn't),
+        # and batch B's r2 item fits (but its r1 item wouldn't, if A held r1).
+        with client_3.access_context( 'r2', True, 1, 1000 ):
+            batch_a.start()
+            time.sleep(0.2)
+            batch_b.start()
+            time.sleep(0.2)
+
+        batch_a.join(5.0)
+        batch_b.join(5.0)
+        assert not batch_a.is_alive() and not batch_b.is_alive(), \
+            "Batches which need the same resources are deadlocked"
+
+
+    @with_server({"read_reqs": 1})
+    def test_17_batch_priority(self):
+        """
+        When several batches are waiting, the one with
+        the highest priority is granted first.
+        """
+        resource = 'my-resource'
+        client_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True, _strict_debug=True)
+        client_3 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True, _strict_debug=True)
+
+        granted = []
+        def waiting_task(client, name, priority):
+            with client.batch_access_context( [(resource, True, 1, 1000)], priority ):
+                granted.append(name)
+                time.sleep(0.1)
+
+        with client_1.access_context( resource, True, 1, 1000 ):
+            low = threading.Thread(target=waiting_task, args=(client_2, 'low', 0))
+            low.start()
+            time.sleep(0.2)
+            high = threading.Thread(target=waiting_task, args=(client_3, 'high', 10))
+            high.start()
+            time.sleep(0.2)
+
+        low.join()
+        high.join()
+        assert granted == ['high', 'low'], f"Batches were granted in the wrong order: {granted}"
+
+    @with_server({"read_reqs": 2})
+    def test_18_priority_not_starved(self):
+        """
+        While a large request with a high priority is waiting,
+        smaller requests with a lower priority can't take the stats it needs,
+        even if they would fit.
+        """
+        resource = 'my-resource'
+        holder_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        holder_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        clients = [ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True, _strict_debug=True) for _ in range(3)]
+
+        granted = []
+        def waiting_task(client, name, numreqs, priority):
+            with client.access_context( resource, True, numreqs, 1000, priority ):
+                granted.append(name)
+                time.sleep(0.1)
+
+        threads = []
+        def start(*args):
+            t = threading.Thread(target=waiting_task, args=args, daemon=True)
+            t.start()
+            threads.append(t)
+            time.sleep(0.2)
+
+        with holder_1.access_context( resource, True, 1, 1000 ):
+            with holder_2.access_context( resource, True, 1, 1000 ):
+                start(clients[0], 'low', 1, 0)
+                start(clients[1], 'high', 2, 10)
+
+            # One read is free now, but it's reserved for the high-priority request,
+            # both for the queued low-priority request and for a new one.
+            start(clients[2], 'low', 1, 0)
+            assert granted == [], f"Low-priority requests were granted ahead of the high-priority request: {granted}"
+
+        for t in threads:
+            t.join(5.0)
+            assert not t.is_alive()
+        assert granted == ['high', 'low', 'low'], f"Requests were granted in the wrong order: {granted}"
+
+    @with_server({"read_reqs": 2})
+    def test_18b_batch_priority_not_starved(self):
+        """
+        Like test_18_priority_not_starved(), but the high-priority work is a batch:
+        single requests with a lower priority can't take the stats it needs.
+        """
+        resource = 'my-resource'
+        holder_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        holder_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        clients = [ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True, _strict_debug=True) for _ in range(3)]
+
+        granted = []
+        def single_task(client, name):
+            with client.access_context( resource, True, 1, 1000, 0 ):
+                granted.append(name)
+                time.sleep(0.1)
+
+        def batch_task(client, name):
+            with client.batch_access_context( [(resource, True, 1, 1000), (resource, True, 1, 1000)], 10 ):
+                granted.append(name)
+                time.sleep(0.1)
+
+        threads = []
+        def start(target, *args):
+            t = threading.Thread(target=target, args=args, daemon=True)
+            t.start()
+            threads.append(t)
+            time.sleep(0.2)
+
+        with holder_1.access_context( resource, True, 1, 1000 ):
+            with holder_2.access_context( resource, True, 1, 1000 ):
+                start(single_task, clients[0], 'low')
+                start(batch_task, clients[1], 'batch')
+
+            # One read is free now, but it's reserved for the batch,
+            # both for the queued request and for a new one.
+            start(single_task, clients[2], 'low')
+            assert granted == [], f"Low-priority requests were granted ahead of the batch: {granted}"
+
+        for t in threads:
+            t.join(5.0)
+            assert not t.is_alive()
+        assert granted == ['batch', 'low', 'low'], f"Requests were granted in the wrong order: {granted}"
+
+    @with_server({"read_reqs": 2})
+    def test_18c_batch_waits_for_priority_request(self):
+        """
+        Conversely, a batch with a lower priority can't take the stats
+        needed by a queued request with a higher priority.
+        """
+        resource = 'my-resource'
+        holder = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        granted = []
+        def single_task():
+            with client_1.access_context( resource, True, 2, 1000, 10 ):
+                granted.append('high')
+                time.sleep(0.1)
+
+        def batch_task():
+            with client_2.batch_access_context( [(resource, True, 1, 1000)], 0 ):
+                granted.append('batch')
+                time.sleep(0.1)
+
+        threads = [threading.Thread(target=single_task, daemon=True),
+                   threading.Thread(target=batch_task, daemon=True)]
+        with holder.access_context( resource, True, 1, 1000 ):
+            for t in threads:
+                t.start()
+                time.sleep(0.2)
+            assert granted == [], f"The batch was granted ahead of the high-priority request: {granted}"
+
+        for t in threads:
+            t.join(5.0)
+            assert not t.is_alive()
+        assert granted == ['high', 'batch'], f"Requests were granted in the wrong order: {granted}"
+
+
+    @with_server({"read_reqs": 1})
+    def test_19_malformed_binary_message(self):
+        """
+        A malformed binary message (or one for an id that isn't granted)
+        gets an error reply, and the server keeps running.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        context = zmq.Context()
+        comm_socket = context.socket(zmq.REQ)
+        comm_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT}')
+        try:
+            # too short, too long, an unknown opcode,
+            # and a release and a hold of ids that don't exist
+            for payload in [b'\x01', b'\x01' + bytes(9), b'\x07' + bytes(8),
+                            b'\x01' + (2**64 - 1).to_bytes(8, "big"),
+                            b'\x00' + (2**40).to_bytes(8, "big")]:
+                comm_socket.send(payload)
+                assert comm_socket.poll(1000), "Server did not reply to a malformed message"
+                assert "error" in orjson.loads(comm_socket.recv())
+
+            with client.access_context( resource, True, 1, 1000 ):
+                pass
+
+            # A duplicate release (via the binary form)
+            with client.access_context( resource, True, 1, 1000 ) as context_:
+                request_id = context_.request_id
+            comm_socket.send(b'\x01' + request_id.to_bytes(8, "big"))
+            assert "error" in orjson.loads(comm_socket.recv())
+            with client.access_context( resource, True, 1, 1000 ):
+                pass
+        finally:
+            comm_socket.close(linger=0)
+            context.term()
+
+
+    def test_20_wait_dispatcher_lifecycle(self):
+        """
+        The wait dispatcher's thread exits when its last client releases it,
+        and a dispatcher whose thread has failed is replaced.
+        """
+        # (Nothing else uses a dispatcher for this port.)
+        dispatcher = _WaitDispatcher.acquire('127.0.0.1', UNUSED_PORT)
+        assert _WaitDispatcher.acquire('127.0.0.1', UNUSED_PORT) is dispatcher
+        dispatcher.release()
+        assert dispatcher._thread.is_alive()
+        dispatcher.release()
+        assert not dispatcher._thread.is_alive()
+
+        with mock.patch.object(_WaitDispatcher, '_dispatch', side_effect=RuntimeError("failed")):
+            dispatcher = _WaitDispatcher.acquire('127.0.0.1', UNUSED_PORT)
+            dispatcher._thread.join(1.0)
+        with self.assertRaises(RuntimeError):
+            dispatcher.wait([b"topic"])
+
+        replacement = _WaitDispatcher.acquire('127.0.0.1', UNUSED_PORT)
+        assert replacement is not dispatcher
+        assert replacement._thread.is_alive()
+        dispatcher.release()
+        replacement.release()
+        assert not replacement._thread.is_alive()
+
+
+    @with_server({"read_reqs": 2})
+    def test_21_nested_or_parallel_access(self):
+        """
+        A (per-thread) client can't enter a second AccessContext
+        while one is active, whether nested or from another thread.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)._get_client()
+        other_client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)._get_client()
+
+        errors = []
+        def parallel_task():
+            try:
+                with client.access_context( resource, True, 1, 1000 ):
+                    pass
+            except AssertionError as ex:
+                errors.append(ex)
+
+        with client.access_context( resource, True, 1, 1000 ):
+            with self.assertRaises(AssertionError):
+                with client.access_context( resource, True, 1, 1000 ):
+                    pass
+
+            # A different client is fine.
+            with other_client.access_context( resource, True, 1, 1000 ):
+                pass
+
+            thread = threading.Thread(target=parallel_task)
+            thread.start()
+            thread.join()
+            assert len(errors) == 1, "Parallel use of a client from another thread was not detected"
+
+        # The client is usable again afterwards.
+        with client.access_context( resource, True, 1, 1000 ):
+            pass
+
+
+    @with_server({"read_reqs": 1})
+    def test_22_unsubscribe_ends_republishing(self):
+        """
+        When a client that skips the 'hold' message unsubscribes from its grant,
+        the server stops republishing it.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        context = zmq.Context()
+        comm_socket = context.socket(zmq.REQ)
+        comm_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT}')
+        monitor_socket = context.socket(zmq.SUB)
+        monitor_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT+1}')
+        monitor_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        sub_socket = context.socket(zmq.SUB)
+        sub_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT+1}')
+        try:
+            with client.access_context( resource, True, 1, 1000 ):
+                comm_socket.send(orjson.dumps({ "type": "request", "resource": resource,
+                                                "read": True, "numopts": 1, "datasize": 1000,
+                                                "skip_hold_ack": True }))
+                response = orjson.loads(comm_socket.recv())
+                assert not response["available"]
+                assert response["skip_hold_ack"]
+
+                topic = response["id"].to_bytes(8, "big")
+                sub_socket.setsockopt(zmq.SUBSCRIBE, topic)
+                time.sleep(0.2)
+
+            assert sub_socket.poll(1000), "Queued request was not granted"
+            assert sub_socket.recv() == topic
+            sub_socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+
+            # Skip anything the monitor received before the unsubscription arrived.
+            time.sleep(0.2)
+            while monitor_socket.poll(0):
+                monitor_socket.recv()
+
+            # Wait past the republish deadline: our id is not published again.
+            deadline = time.time() + dvid_resource_manager.server.PUBDELAY / 1000 + 0.5
+            while time.time() < deadline:
+                if monitor_socket.poll(max(1, int((deadline - time.time()) * 1000))):
+                    assert monitor_socket.recv() != topic, "Grant was republished after the client unsubscribed"
+
+            # The server is shared with other tests, so give the resource back.
+            comm_socket.send(orjson.dumps({ "type": "release", "id": response["id"] }))
+            comm_socket.recv()
+        finally:
+            comm_socket.close(linger=0)
+            monitor_socket.close(linger=0)
+            sub_socket.close(linger=0)
+            context.term()
+
+
+    @with_server({"read_reqs": 1})
+    def test_23_reconfigure_grants_queued_work(self):
+        """
+        When the server is reconfigured with a higher limit,
+        queued work that now fits is granted right away,
+        without waiting for anything to be released.
+        """
+        resource = 'my-resource'
+        client_1 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        client_2 = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        granted = threading.Event()
+        def waiting_task():
+            with client_2.access_context( resource, True, 1, 1000 ):
+                granted.set()
+
+        with client_1.access_context( resource, True, 1, 1000 ):
+            thread = threading.Thread(target=waiting_task, daemon=True)
+            thread.start()
+            time.sleep(0.2)
+            assert not granted.is_set()
+
+            config = client_1.read_config()
+            config["read_reqs"] = 2
+            client_1.reconfigure_server(config)
+            assert granted.wait(1.0), "Queued work was not granted after the limit was raised"
+
+        thread.join(5.0)
+        assert not thread.is_alive()
+
+
+    @with_server({"read_reqs": 1, "write_reqs": 1})
+    def test_24_mixed_read_write_queues(self):
+        """
+        Reads and writes for the same resource wait in separate queues.
+        While the reads are blocked, a released write still grants the waiting write,
+        and vice-versa.
+        """
+        resource = 'my-resource'
+        reader = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        writer = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        waiting_reader = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+        waiting_writer = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        read_granted = threading.Event()
+        write_granted = threading.Event()
+        def waiting_task(client, is_read, granted):
+            with client.access_context( resource, is_read, 1, 1000 ):
+                granted.set()
+
+        threads = [ threading.Thread(target=waiting_task, args=(waiting_reader, True, read_granted), daemon=True),
+                    threading.Thread(target=waiting_task, args=(waiting_writer, False, write_granted), daemon=True) ]
+
+        with reader.access_context( resource, True, 1, 1000 ):
+            with writer.access_context( resource, False, 1, 1000 ):
+                for thread in threads:
+                    thread.start()
+                time.sleep(0.2)
+                assert not read_granted.is_set() and not write_granted.is_set()
+
+            assert write_granted.wait(1.0), "Waiting write was not granted after the write was released"
+            time.sleep(0.2)
+            assert not read_granted.is_set()
+
+        assert read_granted.wait(1.0), "Waiting read was not granted after the read was released"
+        for thread in threads:
+            thread.join(5.0)
+            assert not thread.is_alive()
+
+
+    @with_server({"read_reqs": 1})
+    def test_25_async_client_in_another_thread(self):
+        """
+        An async client (with strict validation) whose event loop runs in another thread
+        can be closed from this thread, and requests that exceed the config are reported.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True, _strict_debug=True)
+
+        loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+        loop_thread.start()
+        try:
+            async def acquire(num_reqs):
+                async with client.access_context_async( resource, True, num_reqs, 1000 ):
+                    return client._get_async_client()
+
+            async_client = asyncio.run_coroutine_threadsafe(acquire(1), loop).result(5.0)
+            with self.assertRaises(RuntimeError):
+                asyncio.run_coroutine_threadsafe(acquire(2), loop).result(5.0)
+
+            # Closed by the loop, on our behalf.
+            async_client.close()
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1), loop).result(5.0)
+            assert async_client._context is None
+            assert async_client._reply_reader.cancelled()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            loop_thread.join(5.0)
+            loop.close()
+
+
+    @with_server({"read_reqs": 1})
+    def test_26_stale_release(self):
+        """
+        Releasing an id that isn't granted (e.g. a duplicate release, after the id's
+        slot has been reused by another request) gets an error reply,
+        and doesn't release anyone else's grant.
+        """
+        request = { "type": "request", "resource": 'my-resource',
+                    "read": True, "numopts": 1, "datasize": 1000 }
+
+        context = zmq.Context()
+        comm_socket = context.socket(zmq.REQ)
+        comm_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT}')
+        sub_socket = context.socket(zmq.SUB)
+        sub_socket.connect(f'tcp://127.0.0.1:{SERVER_PORT+1}')
+        try:
+            comm_socket.send(orjson.dumps(request))
+            first = orjson.loads(comm_socket.recv())
+            assert first["available"]
+            comm_socket.send(orjson.dumps({ "type": "release", "id": first["id"] }))
+            assert orjson.loads(comm_socket.recv()) == {}
+
+            comm_socket.send(orjson.dumps(request))
+            second = orjson.loads(comm_socket.recv())
+            assert second["available"]
+            assert second["id"] != first["id"]
+
+            for msg in [{ "type": "release", "id": first["id"] },
+                        { "type": "release", "id": 2**40 },
+                        { "type": "batch-release", "ids": [second["id"], first["id"]] }]:
+                comm_socket.send(orjson.dumps(msg))
+                assert "error" in orjson.loads(comm_socket.recv())
+
+            # The second request still holds the resource.
+            comm_socket.send(orjson.dumps({ "type": "multi-request", "items": [request] }))
+            third = orjson.loads(comm_socket.recv())["items"][0]
+            assert not third["available"]
+
+            # Releasing the second request grants the third.
+            sub_socket.setsockopt(zmq.SUBSCRIBE, third["id"].to_bytes(8, "big"))
+            comm_socket.send(orjson.dumps({ "type": "release", "id": second["id"] }))
+            assert orjson.loads(comm_socket.recv()) == {}
+            assert sub_socket.poll(1000), "Queued request was not granted"
+
+            comm_socket.send(orjson.dumps({ "type": "release", "id": third["id"] }))
+            assert orjson.loads(comm_socket.recv()) == {}
+        finally:
+            comm_socket.close(linger=0)
+            sub_socket.close(linger=0)
+            context.term()
+
+
+    @with_server({"read_reqs": 1})
+    def test_27_async_cancelled_waiter(self):
+        """
+        If a task is cancelled while its request waits in the server's queue,
+        the request is released once it's granted, so the resource isn't leaked.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        async def hold(duration):
+            async with client.access_context_async( resource, True, 1, 1000 ):
+                await asyncio.sleep(duration)
+
+        async def main():
+            holder = asyncio.ensure_future(hold(0.5))
+            await asyncio.sleep(0.1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(hold(1.0), 0.2)
+            await holder
+
+            # The cancelled request was granted (and released) after the holder exited.
+            await asyncio.wait_for(hold(0.0), 5.0)
+
+        asyncio.run(main())
+
+
+    @with_server({"read_reqs": 1})
+    def test_28_async_cancelled_admission(self):
+        """
+        If tasks are cancelled while their requests await the server's response
+        (or are buffered, waiting to be sent), anything the server grants them is released.
+        """
+        resource = 'my-resource'
+        client = ResourceManagerClient('127.0.0.1', SERVER_PORT, _debug=True)
+
+        async def hold(duration):
+            async with client.access_context_async( resource, True, 1, 1000 ):
+                await asyncio.sleep(duration)
+
+        async def cancel_soon(delay):
+            # The first request is sent right away, and the others are buffered
+            # (and then sent together, after its reply arrives).
+            tasks = [asyncio.ensure_future(hold(0.1)) for _ in range(3)]
+            await asyncio.sleep(delay)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        async def main():
+            # Cancelled before any reply arrives
+            await cancel_soon(0.0)
+            await asyncio.wait_for(hold(0.0), 5.0)
+
+            # Cancelled after the buffered requests were sent
+            holder = asyncio.ensure_future(hold(0.3))
+            await asyncio.sleep(0.1)
+            await cancel_soon(0.05)
+            await holder
+            await asyncio.wait_for(hold(0.0), 5.0)
+
+        asyncio.run(main())
+
+
+class TestNoQueuing(ServerTestCase):
+    server_port = NO_QUEUING_SERVER_PORT
+    server_args = ['--no-queuing']
+
+    @with_server({"read_reqs": 1})
+    def test_rejected(self):
+        """
+        If the server doesn't queue requests, a request that doesn't fit
+        is rejected immediately, rather than waiting.
+        """
+        resource = 'my-resource'
+        client_1 = ResourceManagerClient('127.0.0.1', NO_QUEUING_SERVER_PORT, _debug=True)
+        client_2 = ResourceManagerClient('127.0.0.1', NO_QUEUING_SERVER_PORT, _debug=True)
+
+        with client_1.access_context( resource, True, 1, 1000 ):
+            with self.assertRaises(ResourceUnavailableError):
+                with client_2.access_context( resource, True, 1, 1000 ):
+                    pass
+
+            # None of a rejected batch is granted.
+            with self.assertRaises(ResourceUnavailableError):
+                with client_2.batch_access_context( [('other-resource', True, 1, 1000), (resource, True, 1, 1000)] ):
+                    pass
+
+            with client_2.access_context( 'other-resource', True, 1, 1000 ):
+                pass
+
+        with client_2.access_context( resource, True, 1, 1000 ):
+            pass
+
+
 if __name__ == "__main__":
     #sys.argv += ['Test.test_multiproc']
     unittest.main()
@@ -1,11 +1,26 @@
+import os
 from setuptools import find_packages, setup
 
+# Optionally compile the server module with Cython (as plain python, no annotations needed).
+# The server's main loop is pure-python dict/int manipulation, which Cython speeds up considerably.
+# Opt-in (the conda recipe builds a noarch package), and falls back to pure python if Cython is missing.
+ext_modules = []
+if os.environ.get('DVID_RESOURCE_MANAGER_CYTHON', '') not in ('', '0'):
+    try:
+        from Cython.Build import cythonize
+    except ImportError:
+        print("Cython is not installed.  Building the pure-python package.")
+    else:
+        ext_modules = cythonize( ['dvid_resource_manager/server.py'],
+                                 compiler_directives={'language_level': 3} )
+
 setup( name='dvid_resource_manager',
        version='0.2',
        description='A simple server to manage large-scale batch requests to DVID (or other resources).',
        url='https://github.com/janelia-flyem/DVIDResourceManager',
        packages=find_packages(),
        package_data={},
+       ext_modules=ext_modules,
        entry_points={
           'console_scripts': [
               'dvid_resource_manager = dvid_resource_manager.server:main'